@@ -36,25 +36,54 @@ import bpy
 from bpy.types import PropertyGroup, Operator, Panel, AddonPreferences
 from bpy.props import BoolProperty, IntProperty, EnumProperty, FloatProperty, StringProperty, CollectionProperty, PointerProperty
 from bpy.utils import register_class, unregister_class
+from bpy.app.handlers import persistent
 from progress_report import ProgressReport
 import blf
 import time
 import hashlib
+import json
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import traceback
+import numpy
+from . import imaging
+from .imaging import dilate_margin, denoise, downsample, linear_to_srgb, image_writers
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from mathutils import Matrix
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is not recorded there
+    resource = None
 
 class MeltdownOsd():
     """Hackish on screen display"""
     _msg = ""
     _obj = ""
     _passe = ""
+    _handle = None
+    # redraws per second, 0 turns the display off
+    rate = 4.0
+    _last_draw = 0.0
+    # (time, percent) of the last updates, for the ETA
+    _recent = deque(maxlen=16)
 
     def start(self):
+        self._last_draw = 0.0
+        self._recent = deque(maxlen=16)
+        # nothing to draw on without a window
+        if bpy.app.background or self.rate <= 0.0: return
         self._handle = bpy.types.SpaceView3D.draw_handler_add(self._draw_handler, tuple(), 'WINDOW', 'POST_PIXEL')
 
     def end(self):
         if not self._handle: return
         self.clean()
         bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
+        self._handle = None
         bpy.ops.wm.redraw_timer(type='DRAW_WIN_SWAP', iterations=1)
 
     def _draw_handler(self):
@@ -67,29 +96,949 @@ class MeltdownOsd():
         blf.draw(0,self._passe)
 
     def show(self,msg,obj,passe):
+        # a new pass is always drawn, object and progress updates are throttled,
+        # an atlas changes object on every pair
+        changed = str(passe) != self._passe
         self._msg = str(msg)
         self._obj = str(obj)
         self._passe = str(passe)
+        if not self._handle: return
+        # a window swap is expensive, the next one shows the latest object and progress anyway
+        tm = time.time()
+        if not changed and tm - self._last_draw < 1.0 / self.rate: return
+        self._last_draw = tm
         bpy.ops.wm.redraw_timer(type='DRAW_WIN_SWAP', iterations=1)
 
+    def eta(self):
+        # remaining time at the pace of the recent updates
+        if len(self._recent) < 2: return ""
+        t0, p0 = self._recent[0]
+        t1, p1 = self._recent[-1]
+        if p1 <= p0: return ""
+        remaining = int((100.0 - p1) * (t1 - t0) / (p1 - p0))
+        return " ETA %d:%02d" % (remaining // 60, remaining % 60)
+
     def clean(self):
         self._msg = str()
         self._obj = str()
         self._passe = str()
+        if not self._handle: return
         bpy.ops.wm.redraw_timer(type='DRAW_WIN_SWAP', iterations=1)
 
     def update(self, progress, obj="", passe=""):
+        if not self._handle: return
         steps = sum(s * cs for (s, cs) in zip(progress.steps, progress.curr_step))
         steps_percent = steps / progress.steps[0] * 100.0
         tm = time.time()
+        self._recent.append((tm, steps_percent))
         loc_tm = tm - progress.start_time[-1]
         tm -= progress.start_time[0]
         prefix = "  " * (len(progress.steps) - 1)
-        self.show(prefix + "(%8.4f sec | %8.4f sec) %6.2f%%" % (tm, loc_tm,steps_percent), obj, passe)
+        self.show(prefix + "(%8.4f sec | %8.4f sec) %6.2f%%%s" % (tm, loc_tm, steps_percent, self.eta()), obj, passe)
 
 # Global name
 meltdown_osd = MeltdownOsd()
 
+class MeltdownProfiler():
+    """Wall time and peak memory of bake phases, tagged by job, pass and pair"""
+    def __init__(self):
+        self.enabled = True
+        self.use_memory = False
+        self.reset()
+
+    def reset(self):
+        self.records = []
+        # summary of the finished bake, the panel draws it on every redraw
+        self.last_summary = OrderedDict()
+        self.tags = {'job': "", 'pass': "", 'pair': ""}
+        self.depth = 0
+        self.origin = time.time()
+
+    def tag(self, **tags):
+        for key, value in tags.items():
+            self.tags[key] = value
+
+    def peak_memory(self):
+        # peak resident size in MB
+        if not self.use_memory or resource is None:
+            return 0.0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if os.uname().sysname == 'Darwin':
+            return peak / (1024.0 * 1024.0)
+        return peak / 1024.0
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        record = {'name': name, 'job': self.tags['job'], 'pass': self.tags['pass'], 'pair': self.tags['pair'],
+            'depth': self.depth, 'start': time.time() - self.origin, 'time': 0.0, 'memory': 0.0}
+        self.records.append(record)
+        self.depth += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            record['time'] = time.time() - start
+            record['memory'] = self.peak_memory()
+
+    def summary(self):
+        # name -> [count, total, max], in first seen order
+        phases = OrderedDict()
+        for record in self.records:
+            if record['name'] not in phases:
+                phases[record['name']] = [0, 0.0, 0.0]
+            phase = phases[record['name']]
+            phase[0] += 1
+            phase[1] += record['time']
+            phase[2] = max(phase[2], record['time'])
+        return phases
+
+    def finish(self):
+        self.last_summary = self.summary()
+
+    def to_json(self):
+        return {'records': self.records,
+            'summary': [{'name': name, 'count': count, 'total': total, 'max': peak}
+                for name, (count, total, peak) in self.summary().items()]}
+
+    def to_chrome_trace(self):
+        # complete events, load in chrome://tracing
+        events = []
+        for record in self.records:
+            events.append({'name': record['name'], 'cat': "bake", 'ph': "X", 'pid': 0, 'tid': 0,
+                'ts': int(record['start'] * 1000000), 'dur': int(record['time'] * 1000000),
+                'args': {'job': record['job'], 'pass': record['pass'], 'pair': record['pair'], 'memory': record['memory']}})
+        return {'traceEvents': events, 'displayTimeUnit': "ms"}
+
+# Global name
+meltdown_profiler = MeltdownProfiler()
+
+class MeltdownAtlasIndex():
+    """Object name to texture atlas group, from the ms_lightmap_groups of the Texture Atlas addon"""
+
+    def __init__(self):
+        self.scene_name = None
+        self.groups = {}
+        self.has_atlas = False
+        self.signature = None
+        # a bake pins the index on its source scene, the bake scenes have no atlas groups
+        self.pinned = False
+
+    def build(self, scene):
+        # operators naming files or uv maps rebuild it once when they start
+        if self.pinned and scene.name != self.scene_name:
+            return
+        self.scene_name = scene.name
+        self.groups = {}
+        # atlas file names come from the groups
+        invalidate_filenames()
+        self.has_atlas = hasattr(scene, "ms_lightmap_groups")
+        self.signature = self.get_signature(scene)
+        for name, objects in self.signature or ():
+            for object in objects:
+                if object not in self.groups:
+                    self.groups[object] = name
+
+    def get_signature(self, scene):
+        # atlas names and their object names, None without the Texture Atlas addon
+        if not hasattr(scene, "ms_lightmap_groups"):
+            return None
+        signature = []
+        for atlas in scene.ms_lightmap_groups:
+            group = bpy.data.groups.get(atlas.name)
+            if group is not None:
+                signature.append((atlas.name, tuple(object.name for object in group.objects)))
+        return tuple(signature)
+
+    def refresh(self, scene):
+        # the panel checks once per redraw, atlas groups edited since the last build rebuild the index
+        if self.pinned:
+            return
+        if self.scene_name != scene.name or self.get_signature(scene) != self.signature:
+            self.build(scene)
+
+    def ensure(self, scene):
+        if self.scene_name is None:
+            self.build(scene)
+
+    def pin(self, scene):
+        self.pinned = False
+        self.build(scene)
+        self.pinned = True
+
+    def unpin(self):
+        self.pinned = False
+
+    def invalidate(self):
+        # groups may have changed, the next ensure rebuilds
+        if not self.pinned:
+            self.scene_name = None
+
+    def get_group(self, name):
+        return self.groups.get(name)
+
+    def get_uvtex_name(self, name):
+        # use group name as uvtex_name if any
+        return self.groups.get(name, 'Auto-Unwrap')
+
+# Global name
+meltdown_atlas_index = MeltdownAtlasIndex()
+
+class MeltdownBakeSession():
+    """Temporary bake scene shared by every pass of a job"""
+
+    def __init__(self, scene, pairs):
+        self.scene = scene
+        self.pairs = pairs
+        # source object name -> copy in the bake scene
+        self.objects = {}
+        self.materials = {}
+        self.groups = {}
+        # lowpoly name -> highpoly group
+        self.highpolys = {}
+        # source material name -> material id override
+        self.material_id = {}
+        self.use_material_id = False
+        self.visible = set()
+        # lowpoly name -> (uv layer name, original uvs)
+        self.uvs = {}
+
+class MeltdownTempRegistry():
+    """Datablocks created while baking, by name for each bpy.data collection"""
+
+    # removal order, objects go first so their data lose the users
+    attrs = ["objects", "scenes", "groups", "meshes", "curves", "metaballs", "lattices", "armatures",
+             "lamps", "cameras", "speakers", "particles", "materials", "textures", "images", "worlds", "linestyles"]
+
+    obdata_attrs = {'MESH': "meshes", 'CURVE': "curves", 'SURFACE': "curves", 'FONT': "curves",
+                    'META': "metaballs", 'LATTICE': "lattices", 'ARMATURE': "armatures",
+                    'LAMP': "lamps", 'CAMERA': "cameras", 'SPEAKER': "speakers"}
+
+    def __init__(self):
+        self.blocks = dict((attr, []) for attr in self.attrs)
+
+    def add(self, attr, block):
+        self.blocks[attr].append(block.name)
+        return block
+
+    def add_data(self, object):
+        # object data copied for the bake
+        if object.data is not None and object.type in self.obdata_attrs:
+            self.add(self.obdata_attrs[object.type], object.data)
+
+    def cleanup(self):
+        for attr in self.attrs:
+            blocks = getattr(bpy.data, attr)
+            for name in self.blocks[attr]:
+                idx = blocks.find(name)
+                if idx > -1:
+                    blocks.remove(blocks[idx], do_unlink=True)
+            self.blocks[attr] = []
+
+
+def read_pixels(image):
+    # image pixels as a (height, width, 4) float array
+    width, height = image.size
+    pixels = numpy.empty(width * height * 4, dtype=numpy.float32)
+    if hasattr(image.pixels, "foreach_get"):
+        image.pixels.foreach_get(pixels)
+    else:
+        pixels[:] = image.pixels[:]
+    return pixels.reshape(height, width, 4)
+
+def write_pixels(image, pixels):
+    pixels = numpy.ascontiguousarray(pixels, dtype=numpy.float32).ravel()
+    if hasattr(image.pixels, "foreach_set"):
+        image.pixels.foreach_set(pixels)
+    else:
+        image.pixels[:] = pixels.tolist()
+
+class MeltdownPostWorker():
+    """Margin fill, downsample and file writing of finished passes in worker processes,
+    at most size passes in flight cap the pass buffers held in memory"""
+
+    # seconds without any finished pass before the passes in flight are given up,
+    # a killed worker process takes its task with it
+    timeout = 600.0
+
+    def __init__(self, size):
+        self.results = queue.Queue()
+        # filepath -> main thread save for formats without writer, callbacks once the file is written
+        self.pending = {}
+        self.slots = threading.BoundedSemaphore(size)
+        self.lost = False
+        # a process does not wait for the interpreter lock bpy.ops holds while baking,
+        # without fork the passes are processed right away
+        self.pool = imaging.post_pool(size)
+
+    def put(self, filepath, pixels, format, save, margin=0, factor=1, filter_width=0.0, linear=False):
+        # waits while size passes are in flight
+        self.pending[filepath] = {'save': save, 'done': []}
+        task = {'filepath': filepath, 'pixels': pixels, 'format': format,
+            'margin': margin, 'factor': factor, 'filter_width': filter_width, 'linear': linear}
+        if not self.slots.acquire(timeout=self.timeout):
+            self.give_up()
+            raise RuntimeError("Post process workers stopped responding")
+        if self.pool is None:
+            self.done(imaging.post_process(task))
+        else:
+            self.pool.apply_async(imaging.post_process, (task,), callback=self.done,
+                error_callback=lambda error: self.done((filepath, None, "Post process failed: %r" % error)))
+
+    def done(self, result):
+        # on the pool result thread
+        self.slots.release()
+        self.results.put(result)
+
+    def give_up(self):
+        # fail every pass in flight, stop terminates the workers
+        self.lost = True
+        for filepath in list(self.pending.keys()):
+            self.results.put((filepath, None, "Post process worker lost the pass"))
+
+    def stop(self):
+        if self.pool is not None:
+            if self.lost:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+        self.pool = None
+
+class MeltdownRaster():
+    """Triangles scan converted in uv space, for passes that need no ray tracing"""
+
+    # pixels processed at once
+    chunk = 1 << 20
+
+    def __init__(self, width, height, samples=1, blend=True):
+        self.width = width
+        self.height = height
+        # samples per pixel side, samples * samples per pixel
+        self.samples = samples
+        # without blending an edge pixel takes the triangle covering most of it, for ids
+        self.blend = blend
+        # channel first, rows of three edges or three channels are contiguous
+        self.color = numpy.zeros((3, width * height), dtype=numpy.float32)
+        self.weight = numpy.zeros(width * height, dtype=numpy.float32)
+
+    def add(self, uvs, values):
+        # uvs (n, 3, 2) triangle corners in uv space, values (n, 3, 3) interpolated over the triangles
+        width, height = self.width, self.height
+        x = uvs[:, :, 0].T.astype(numpy.float64) * width
+        y = uvs[:, :, 1].T.astype(numpy.float64) * height
+
+        # barycentric coordinates as edge functions, w = A * x + B * y + C
+        A = numpy.stack((y[1] - y[2], y[2] - y[0], y[0] - y[1]))
+        B = numpy.stack((x[2] - x[1], x[0] - x[2], x[1] - x[0]))
+        C = numpy.stack((x[1] * y[2] - x[2] * y[1], x[2] * y[0] - x[0] * y[2], x[0] * y[1] - x[1] * y[0]))
+        area = A[0] * x[0] + B[0] * y[0] + C[0]
+
+        # degenerate triangles and triangles out of the 0-1 range are not baked
+        xmin, xmax = x.min(axis=0), x.max(axis=0)
+        ymin, ymax = y.min(axis=0), y.max(axis=0)
+        keep = numpy.flatnonzero((numpy.abs(area) > 1e-12) & (xmax > 0) & (xmin < width) & (ymax > 0) & (ymin < height))
+        if len(keep) < 1:
+            return
+        area = area[keep]
+        A, B, C = A[:, keep] / area, B[:, keep] / area, C[:, keep] / area
+        y0 = numpy.clip(numpy.floor(ymin[keep]), 0, height - 1).astype(numpy.int64)
+        y1 = numpy.clip(numpy.ceil(ymax[keep]) - 1, 0, height - 1).astype(numpy.int64)
+        # values are planes in pixel space, v = Px * x + Py * y + P0
+        values = values[keep].astype(numpy.float64)
+        Px = numpy.einsum('it,tic->ct', A, values)
+        Py = numpy.einsum('it,tic->ct', B, values)
+        P0 = numpy.einsum('it,tic->ct', C, values)
+
+        # one span per triangle row
+        rows = y1 - y0 + 1
+        tri = numpy.repeat(numpy.arange(len(keep)), rows)
+        row = numpy.arange(len(tri)) - numpy.repeat(numpy.cumsum(rows) - rows, rows) + numpy.take(y0, tri)
+        yc = row + 0.5
+
+        # pixel centers where every edge function reaches lo, lo = +-half a pixel in barycentric units
+        Ar = numpy.take(A, tri, axis=1)
+        Br = numpy.take(B, tri, axis=1)
+        D = Br * yc + numpy.take(C, tri, axis=1)
+        R = 0.5 * (numpy.abs(Ar) + numpy.abs(Br))
+        del Br
+
+        def span(lo):
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                bound = (lo - D) / Ar
+            lower = numpy.maximum.reduce(numpy.where(Ar > 0.0, bound, -numpy.inf))
+            upper = numpy.minimum.reduce(numpy.where(Ar < 0.0, bound, numpy.inf))
+            empty = numpy.logical_or.reduce((Ar == 0.0) & (D < lo))
+            first = numpy.clip(numpy.ceil(lower - 0.5), 0, width)
+            last = numpy.clip(numpy.floor(upper - 0.5), -1, width - 1)
+            last[empty] = -1
+            return first.astype(numpy.int64), last.astype(numpy.int64)
+
+        outer_first, outer_last = span(-R)
+        inner_first, inner_last = span(R)
+        del Ar, R
+        counts = numpy.maximum(outer_last - outer_first + 1, 0)
+        ends = numpy.cumsum(counts)
+        # value at the start of each row
+        Q = (numpy.take(Py, tri, axis=1) * yc + numpy.take(P0, tri, axis=1)).astype(numpy.float32)
+        Px = Px.astype(numpy.float32)
+
+        start = 0
+        while start < len(tri):
+            end = max(int(numpy.searchsorted(ends, ends[start] - counts[start] + self.chunk, side='right')), start + 1)
+            items = slice(start, end)
+            self.add_spans(counts[items], row[items], outer_first[items], inner_first[items], inner_last[items],
+                tri[items], D[:, items], Q[:, items], A, B, Px)
+            start = end
+
+    def add_spans(self, counts, row, first, inner_first, inner_last, tri, D, Q, A, B, Px):
+        # pixels of each span
+        item = numpy.repeat(numpy.arange(len(counts)), counts)
+        px = numpy.arange(len(item)) - numpy.repeat(numpy.cumsum(counts) - counts - first, counts)
+        flat = numpy.take(row, item) * self.width + px
+        t = numpy.take(tri, item)
+        xc = (px + 0.5).astype(numpy.float32)
+
+        # pixels fully covered by one triangle, the average of a linear value is its value at the center,
+        # overlapping uvs keep the last triangle as the bake does
+        inside = numpy.flatnonzero((px >= numpy.take(inner_first, item)) & (px <= numpy.take(inner_last, item)))
+        pixels = numpy.take(flat, inside)
+        color = numpy.take(Px, numpy.take(t, inside), axis=1) * numpy.take(xc, inside) + \
+            numpy.take(Q, numpy.take(item, inside), axis=1)
+        for c in range(3):
+            self.color[c][pixels] = color[c]
+        self.weight[pixels] = numpy.ones(len(pixels), dtype=numpy.float32)
+
+        # pixels on triangle edges, coverage from a regular grid of samples
+        edge = numpy.ones(len(item), dtype=bool)
+        edge[inside] = False
+        edge = numpy.flatnonzero(edge)
+        if len(edge) < 1:
+            return
+        item = numpy.take(item, edge)
+        t = numpy.take(t, edge)
+        xc = numpy.take(xc, edge)
+        At = numpy.take(A, t, axis=1)
+        Bt = numpy.take(B, t, axis=1)
+        w = At * xc + numpy.take(D, item, axis=1)
+        hits = numpy.zeros(len(edge), dtype=numpy.float32)
+        offsets = (numpy.arange(self.samples) + 0.5) / self.samples - 0.5
+        for dy in offsets:
+            for dx in offsets:
+                hits += numpy.logical_and.reduce(w + At * dx + Bt * dy >= 0.0)
+        covered = numpy.flatnonzero(hits)
+        hits = numpy.take(hits, covered) / (self.samples * self.samples)
+        item = numpy.take(item, covered)
+        color = numpy.take(Px, numpy.take(t, covered), axis=1) * numpy.take(xc, covered) + numpy.take(Q, item, axis=1)
+        pixels = numpy.take(flat, numpy.take(edge, covered))
+        if not self.blend:
+            # weight holds the best coverage so far, of repeated pixels the last and largest is assigned
+            order = numpy.argsort(hits, kind='mergesort')
+            pixels, hits, color = pixels[order], hits[order], color[:, order]
+            better = numpy.flatnonzero(hits >= self.weight[pixels])
+            pixels = pixels[better]
+            for c in range(3):
+                self.color[c][pixels] = color[c][better]
+            self.weight[pixels] = hits[better]
+            return
+        for c in range(3):
+            numpy.add.at(self.color[c], pixels, color[c] * hits)
+        numpy.add.at(self.weight, pixels, hits)
+
+    def pixels(self):
+        # (height, width, 4) pixels, covered texels are opaque
+        pixels = numpy.zeros((self.height * self.width, 4), dtype=numpy.float32)
+        covered = numpy.flatnonzero(self.weight)
+        if self.blend:
+            pixels[covered, :3] = (numpy.take(self.color, covered, axis=1) / numpy.take(self.weight, covered)).T
+        else:
+            pixels[covered, :3] = numpy.take(self.color, covered, axis=1).T
+        pixels[covered, 3] = 1.0
+        return pixels.reshape(self.height, self.width, 4)
+
+class MeltdownTargetPool():
+    """Bake target images reused between passes, least recently used are evicted first"""
+
+    def __init__(self):
+        # memory ceiling in bytes, 0 for no limit
+        self.limit = 0
+        # image name -> (width, height, float, alpha), most recently used last
+        self.images = OrderedDict()
+        self.in_use = set()
+
+    def image_size(self, key):
+        width, height, use_float, alpha = key
+        if use_float:
+            return width * height * 4 * 4
+        return width * height * 4
+
+    def acquire(self, width, height, use_float=False, alpha=True):
+        # the first bake of a pass runs with use_clear, a reused image is cleared there
+        key = (width, height, use_float, alpha)
+        name = None
+        for image_name, image_key in reversed(list(self.images.items())):
+            if image_key == key and image_name not in self.in_use and bpy.data.images.find(image_name) > -1:
+                name = image_name
+                break
+
+        if name is None:
+            self.evict(self.image_size(key))
+            image = bpy.data.images.new("MDtarget", width=width, height=height, alpha=alpha, float_buffer=use_float)
+            image.generated_color = (0.0, 0.0, 0.0, 0.0)
+            name = image.name
+        else:
+            del self.images[name]
+
+        self.images[name] = key
+        self.in_use.add(name)
+        return bpy.data.images[name]
+
+    def release(self, image):
+        self.in_use.discard(image.name)
+
+    def evict(self, size):
+        total = size
+        for key in self.images.values():
+            total += self.image_size(key)
+        for name, key in list(self.images.items()):
+            if self.limit < 1 or total <= self.limit:
+                break
+            if name in self.in_use:
+                continue
+            total -= self.image_size(key)
+            del self.images[name]
+            self.remove(name)
+
+    def remove(self, name):
+        idx = bpy.data.images.find(name)
+        if idx < 0:
+            return
+        image = bpy.data.images[idx]
+        #unlink from image editors
+        for wm in bpy.data.window_managers:
+            for window in wm.windows:
+                for area in window.screen.areas:
+                    if area.type == "IMAGE_EDITOR" and area.spaces[0].image == image:
+                        area.spaces[0].image = None
+
+        bpy.data.images.remove(image, do_unlink=True)
+
+    def clear(self):
+        for name in self.images.keys():
+            self.remove(name)
+        self.images.clear()
+        self.in_use.clear()
+
+# Global name
+meltdown_target_pool = MeltdownTargetPool()
+
+class MeltdownCompositor():
+    """Margin and anti-aliasing compositor scene, built once and reused for every pass"""
+
+    def __init__(self):
+        self.scene_name = None
+
+    def get_scene(self):
+        if self.scene_name is not None and bpy.data.scenes.find(self.scene_name) > -1:
+            return bpy.data.scenes[self.scene_name]
+
+        scene = bpy.data.scenes.new("MD_COMPO")
+        self.scene_name = scene.name
+
+        # make sure the compositor is using nodes
+        scene.use_nodes = True
+        # make sure the scene use compositor
+        scene.render.use_compositing = True
+        scene.render.resolution_percentage = 100
+        scene.render.image_settings.compression = 0
+
+        tree = scene.node_tree
+
+        # get rid of all nodes
+        for node in tree.nodes:
+            tree.nodes.remove(node)
+
+        # make a dictionary of all the nodes we're going to need
+        # the vector is for placement only, otherwise useless
+        nodes = {
+            "Image": ["CompositorNodeImage", (-900.0, 100.0)],
+            "Inpaint": ["CompositorNodeInpaint", (-700.0, 100.0)],
+            "Filter": ["CompositorNodeValue", (-700.0, -100.0)],
+            "Negative": ["CompositorNodeMath", (-700.0, -300.0)],
+            "TF1": ["CompositorNodeTransform", (-500.0, 100.0)],
+            "TF2": ["CompositorNodeTransform", (-500.0, -100.0)],
+            "TF3": ["CompositorNodeTransform", (-500.0, -300.0)],
+            "TF4": ["CompositorNodeTransform", (-500.0, -500.0)],
+            "Mix1": ["CompositorNodeMixRGB", (-300.0, 100.0)],
+            "Mix2": ["CompositorNodeMixRGB", (-300.0, -300.0)],
+            "Mix3": ["CompositorNodeMixRGB", (-100.0, 100.0)],
+            "Output": ["CompositorNodeComposite", (200.0, 100.0)]
+        }
+
+        # add all the listed nodes
+        for key, node_data in nodes.items():
+            node = tree.nodes.new(type = node_data[0])
+            node.location = node_data[1]
+            node.name = key
+            node.label = key
+
+        links = [
+            ["Image", "Image", "Inpaint", "Image"],
+            ["Filter", "Value", "Negative", 1],
+            ["Inpaint", "Image", "TF1", "Image"],
+            ["Inpaint", "Image", "TF2", "Image"],
+            ["Inpaint", "Image", "TF3", "Image"],
+            ["Inpaint", "Image", "TF4", "Image"],
+            ["Filter", "Value", "TF1", 2],
+            ["Filter", "Value", "TF2", 1],
+            ["Filter", "Value", "TF2", 2],
+            ["Filter", "Value", "TF4", 1],
+            ["Negative", "Value", "TF1", 1],
+            ["Negative", "Value", "TF3", 1],
+            ["Negative", "Value", "TF3", 2],
+            ["Negative", "Value", "TF4", 2],
+            ["TF1", "Image", "Mix1", 1],
+            ["TF2", "Image", "Mix1", 2],
+            ["TF3", "Image", "Mix2", 1],
+            ["TF4", "Image", "Mix2", 2],
+            ["Mix1", "Image", "Mix3", 1],
+            ["Mix2", "Image", "Mix3", 2],
+            ["Mix3", "Image", "Output", "Image"]
+        ]
+
+        for link in links:
+            output = tree.nodes[link[0]].outputs[link[1]]
+            input = tree.nodes[link[2]].inputs[link[3]]
+            tree.links.new(output, input)
+
+        tree.nodes["Negative"].inputs[0].default_value = 0.0
+        tree.nodes["Negative"].operation = "SUBTRACT"
+        tree.nodes["TF1"].filter_type = "BICUBIC"
+        tree.nodes["TF2"].filter_type = "BICUBIC"
+        tree.nodes["TF3"].filter_type = "BICUBIC"
+        tree.nodes["TF4"].filter_type = "BICUBIC"
+        tree.nodes["Mix1"].inputs[0].default_value = 0.5
+        tree.nodes["Mix2"].inputs[0].default_value = 0.5
+        tree.nodes["Mix3"].inputs[0].default_value = 0.5
+
+        return scene
+
+    def render(self, job, filepath, targetimage):
+        scene = self.get_scene()
+        scene.render.resolution_x = job.resolutionX
+        scene.render.resolution_y = job.resolutionY
+        scene.render.image_settings.file_format = job.output_format
+        scene.render.filepath = filepath
+
+        margin = job.margin * job.get_aa_factor()
+        filter_width = job.get_filter_width()
+        transform_scale = 1.0 / job.get_aa_factor()
+
+        print("filter "+str(filter_width))
+
+        tree = scene.node_tree
+        tree.nodes["Image"].image = targetimage
+        tree.nodes["Inpaint"].distance = margin
+        tree.nodes["Filter"].outputs[0].default_value = filter_width
+        tree.nodes["TF1"].inputs[4].default_value = transform_scale
+        tree.nodes["TF2"].inputs[4].default_value = transform_scale
+        tree.nodes["TF3"].inputs[4].default_value = transform_scale
+        tree.nodes["TF4"].inputs[4].default_value = transform_scale
+
+        bpy.ops.render.render(write_still = True, scene = scene.name)
+
+    def save(self, job, filepath, image):
+        # write an image with the output settings of the compositor
+        scene = self.get_scene()
+        scene.render.image_settings.file_format = job.output_format
+        image.save_render(bpy.path.abspath(filepath), scene=scene)
+
+    def free(self):
+        if self.scene_name is not None and bpy.data.scenes.find(self.scene_name) > -1:
+            bpy.data.scenes.remove(bpy.data.scenes[self.scene_name], do_unlink=True)
+        self.scene_name = None
+
+# ui and bookkeeping props, changing them does not change the bake
+hash_skip_props = {'rna_type', 'tag', 'select', 'hide', 'show_expanded'}
+# node editor layout, the same names are real settings elsewhere (bevel width)
+hash_skip_node_props = {'location', 'width', 'height', 'width_hidden'}
+
+def hash_rna(md5, data, skip=set()):
+    # every editable value of a datablock, datablock pointers by name and transform,
+    # collections are up to the caller
+    for prop in data.bl_rna.properties:
+        if prop.identifier in hash_skip_props or prop.identifier in skip:
+            continue
+        if prop.type == 'COLLECTION' or prop.is_readonly:
+            continue
+        value = getattr(data, prop.identifier, None)
+        if prop.type == 'POINTER':
+            # boolean, displace or array targets, nested structs are hashed by the caller
+            if value is not None and not isinstance(value, bpy.types.ID):
+                continue
+            if value is not None:
+                target = value.name
+                if isinstance(value, bpy.types.Object):
+                    target = (value.name, tuple(tuple(row) for row in value.matrix_world))
+                value = target
+        if getattr(prop, "array_length", 0) > 0:
+            value = tuple(value)
+        md5.update(("%s=%r;" % (prop.identifier, value)).encode('utf-8'))
+
+def hash_image(md5, image):
+    if image is None:
+        return
+    md5.update(("image:%s:%s:%r" % (image.name, image.filepath, tuple(image.size))).encode('utf-8'))
+    filepath = bpy.path.abspath(image.filepath)
+    if image.packed_file is None and os.path.exists(filepath):
+        md5.update(("%r" % os.path.getmtime(filepath)).encode('utf-8'))
+
+def hash_node_tree(md5, tree):
+    if tree is None:
+        return
+    for node in tree.nodes:
+        hash_rna(md5, node, skip=hash_skip_node_props)
+        for socket in node.inputs:
+            if hasattr(socket, "default_value"):
+                value = socket.default_value
+                if not isinstance(value, (int, float)):
+                    value = tuple(value)
+                md5.update(("%s=%r;" % (socket.identifier, value)).encode('utf-8'))
+        if getattr(node, "image", None) is not None:
+            hash_image(md5, node.image)
+        if getattr(node, "node_tree", None) is not None:
+            hash_node_tree(md5, node.node_tree)
+    for link in tree.links:
+        md5.update(("%s.%s>%s.%s;" % (link.from_node.name, link.from_socket.identifier,
+            link.to_node.name, link.to_socket.identifier)).encode('utf-8'))
+
+def hash_material(md5, mat):
+    if mat is None:
+        md5.update(b"material:None;")
+        return
+    md5.update(("material:%s;" % mat.name).encode('utf-8'))
+    hash_rna(md5, mat)
+    if mat.use_nodes:
+        hash_node_tree(md5, mat.node_tree)
+    for slot in mat.texture_slots:
+        if slot is None or slot.texture is None:
+            continue
+        hash_rna(md5, slot)
+        hash_rna(md5, slot.texture)
+        if slot.texture.type == 'IMAGE':
+            hash_image(md5, slot.texture.image)
+
+def hash_mesh(md5, mesh):
+    for collection, attr, dtype in ((mesh.vertices, "co", numpy.float32),
+                                    (mesh.loops, "vertex_index", numpy.int32),
+                                    (mesh.polygons, "loop_total", numpy.int32),
+                                    (mesh.polygons, "material_index", numpy.int32),
+                                    (mesh.polygons, "use_smooth", numpy.bool_)):
+        size = 3 if attr == "co" else 1
+        values = numpy.empty(len(collection) * size, dtype=dtype)
+        collection.foreach_get(attr, values)
+        md5.update(values.tobytes())
+    for layer in mesh.uv_layers:
+        md5.update(layer.name.encode('utf-8'))
+        values = numpy.empty(len(layer.data) * 2, dtype=numpy.float32)
+        layer.data.foreach_get("uv", values)
+        md5.update(values.tobytes())
+
+def hash_object(md5, object, done):
+    # done prevents hashing shared objects and dupli groups twice
+    if object is None or object.name in done:
+        return
+    done.add(object.name)
+    md5.update(("object:%s:%r;" % (object.name, object.matrix_world)).encode('utf-8'))
+    if object.type == 'MESH':
+        hash_mesh(md5, object.data)
+    elif object.data is not None:
+        hash_rna(md5, object.data)
+    for mod in object.modifiers:
+        hash_rna(md5, mod)
+    # data materials, object slots only hold the baked preview materials
+    for mat in getattr(object.data, "materials", []):
+        hash_material(md5, mat)
+    if object.type == 'EMPTY' and object.dupli_group is not None:
+        for child in object.dupli_group.objects:
+            hash_object(md5, child, done)
+
+class MeltdownBakeCache():
+    """Input hashes of baked files, kept next to the files so they survive restarts"""
+    filename = ".meltdown_cache.json"
+
+    def __init__(self):
+        # output directory -> {file name: {"key", "mtime"}}
+        self.dirs = {}
+
+    def get_path(self, dirpath):
+        return os.path.join(dirpath, self.filename)
+
+    def load(self, dirpath):
+        entries = {}
+        path = self.get_path(dirpath)
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                print("MeltdownBakeCache unable to read %s" % path)
+        return entries
+
+    def get_entries(self, dirpath):
+        if dirpath not in self.dirs:
+            self.dirs[dirpath] = self.load(dirpath)
+        return self.dirs[dirpath]
+
+    def is_valid(self, filepath, key):
+        # same inputs and the file is the one we wrote
+        if not os.path.exists(filepath):
+            return False
+        dirpath, filename = os.path.split(filepath)
+        entry = self.get_entries(dirpath).get(filename)
+        return entry is not None and entry['key'] == key and entry['mtime'] == os.path.getmtime(filepath)
+
+    def store(self, filepath, key):
+        dirpath, filename = os.path.split(filepath)
+        self.get_entries(dirpath)[filename] = {'key': key, 'mtime': os.path.getmtime(filepath)}
+
+    @contextmanager
+    def lock(self, dirpath):
+        # farm workers share output directories, one of them merges at a time
+        path = self.get_path(dirpath) + ".lock"
+        start = time.time()
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                # a crashed worker leaves its lock behind
+                if time.time() - start > 10.0:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    start = time.time()
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            os.remove(path)
+
+    def save(self):
+        for dirpath, entries in self.dirs.items():
+            path = self.get_path(dirpath)
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            try:
+                with self.lock(dirpath):
+                    # merge with entries written meanwhile, then replace, readers never see a partial file
+                    merged = self.load(dirpath)
+                    merged.update(entries)
+                    with open(tmp, 'w') as f:
+                        json.dump(merged, f, indent=1, sort_keys=True)
+                    os.replace(tmp, path)
+            except (OSError, ValueError):
+                print("MeltdownBakeCache unable to write %s" % path)
+
+class MeltdownCheckpoint():
+    """Output files finished by the current bake run, to resume after a crash"""
+
+    def __init__(self):
+        self.files = []
+        # next to the .blend, so a restarted Blender finds it
+        if bpy.data.filepath:
+            self.path = bpy.data.filepath + ".meltdown_checkpoint.json"
+        else:
+            self.path = os.path.join(tempfile.gettempdir(), "meltdown_checkpoint.json")
+
+    def load(self):
+        self.files = []
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.files = json.load(f)['files']
+            except (OSError, ValueError, KeyError, TypeError):
+                # unreadable, not json or not a checkpoint
+                print("MeltdownCheckpoint unable to read %s" % self.path)
+
+    def is_done(self, filepath):
+        return filepath in self.files and os.path.exists(filepath)
+
+    def add(self, filepath):
+        if filepath not in self.files:
+            self.files.append(filepath)
+        self.save()
+
+    def save(self):
+        # write then rename, a crash while writing keeps the previous checkpoint
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'blend': bpy.data.filepath, 'time': time.time(), 'files': self.files}, f, indent=1)
+            os.replace(tmp, self.path)
+        except (OSError, ValueError):
+            print("MeltdownCheckpoint unable to write %s" % self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def rna_to_dict(data):
+    """Plain python copy of a property group, collections become lists"""
+    values = {}
+    for prop in data.bl_rna.properties:
+        if prop.identifier == 'rna_type':
+            continue
+        value = getattr(data, prop.identifier)
+        if prop.type == 'COLLECTION':
+            values[prop.identifier] = [rna_to_dict(item) for item in value]
+        elif prop.type == 'POINTER' or prop.is_readonly:
+            continue
+        elif prop.type == 'ENUM' and prop.is_enum_flag:
+            values[prop.identifier] = list(value)
+        elif getattr(prop, "array_length", 0) > 0:
+            values[prop.identifier] = list(value)
+        else:
+            values[prop.identifier] = value
+    return values
+
+def rna_from_dict(data, values):
+    """Restore a property group from rna_to_dict output"""
+    # follow declaration order, so enum items depending on other props (engine -> pass_name) resolve
+    for prop in data.bl_rna.properties:
+        if prop.identifier not in values:
+            continue
+        value = values[prop.identifier]
+        if prop.type == 'COLLECTION':
+            collection = getattr(data, prop.identifier)
+            collection.clear()
+            for item in value:
+                rna_from_dict(collection.add(), item)
+            continue
+        if prop.type == 'ENUM' and prop.is_enum_flag:
+            value = set(value)
+        try:
+            setattr(data, prop.identifier, value)
+        except (AttributeError, TypeError, ValueError):
+            print("rna_from_dict unable to set %s" % prop.identifier)
+
+# Global name
+# (atlas index scene name, pair lowpolys) -> output file name, without pass and extension
+meltdown_filenames = {}
+
+def invalidate_filenames():
+    # atlas groups changed
+    meltdown_filenames.clear()
+
+@persistent
+def invalidate_filenames_handler(dummy):
+    # undo and file loading change atlas groups
+    meltdown_filenames.clear()
+    meltdown_atlas_index.invalidate()
 
 class BakePair(PropertyGroup):
     activated = BoolProperty(name = "Activated", description="Pair on/off", default = True)
@@ -184,6 +1133,11 @@ class BakePass(PropertyGroup):
     material_override = StringProperty(name="Material Override", description="", default="")
     ao_distance = FloatProperty(name="Distance", description="", default=10.0, min=0.0)
     samples = IntProperty(name="Samples", description="", default=4)
+    adaptive = BoolProperty(name="Adaptive", description="Bake rounds of Samples with different seeds until the noise is under the threshold", default=False)
+    noise_threshold = FloatProperty(name="Noise", description="Noise of the baked texels to reach, standard error of their mean in linear light, rounds bake into float targets", default=0.005, min=0.0001, max=1.0, precision=4)
+    max_samples = IntProperty(name="Max Samples", description="Stop adding rounds past this many samples", default=256, min=1)
+    denoise = FloatProperty(name="Denoise", description="Strength of the denoise filter run before the margin is filled, 0 to turn it off", default=0.0, min=0.0, max=1.0)
+    time_budget = FloatProperty(name="Time Budget", description="Seconds for all rounds of the pass, 0 for no limit", default=0.0, min=0.0)
     clean_environment = BoolProperty(name = "Clean Environment", default = False)
 
     # cycles baking props
@@ -227,6 +1181,15 @@ class BakePass(PropertyGroup):
     bi_normalized  = BoolProperty(name = "Normalized", default = False)
     bi_multires  = BoolProperty(name = "Bake from Multires", default = False)
 
+    def is_data_pass(self):
+        # the result only depends on geometry and materials, not on lighting or the scene around
+        if self.pass_name in ["NORMAL", "NORMALS"]:
+            return self.nm_space in ["TANGENT", "OBJECT"]
+        if self.pass_name in ["DIFFUSE", "GLOSSY", "TRANSMISSION", "SUBSURFACE"]:
+            return self.get_pass_filter() == {"COLOR"}
+        return self.pass_name in ["MAT_ID", "UV", "EMIT", "ALPHA", "VERTEX_COLORS", "DERIVATIVE", "DISPLACEMENT",
+            "TEXTURE", "SPEC_COLOR", "SPEC_INTENSITY", "MIRROR_COLOR", "MIRROR_INTENSITY", "MATERIAL_INDEX"]
+
     def get_pass_fullname(self):
         pass_fullname = self.pass_name
         pass_filter = self.get_pass_filter()
@@ -312,6 +1275,15 @@ class BakePass(PropertyGroup):
                     row.prop(self, 'normal_b', text = "")
                 else:
                     row.prop(self, "samples")
+                    if not self.is_data_pass():
+                        row.prop(self, "adaptive")
+                        row.prop(self, "denoise")
+                        if self.adaptive:
+                            row = layout.row(align=True)
+                            row.alignment = 'EXPAND'
+                            row.prop(self, "noise_threshold")
+                            row.prop(self, "max_samples")
+                            row.prop(self, "time_budget")
 
 
                 if self.pass_name == "AO":
@@ -402,6 +1374,11 @@ class BakeJob(PropertyGroup):
                                             ("2", "2x", ""),
                                              ("4","4x","")))
     aa_sharpness = FloatProperty(name="AA Sharpness", description="", default=0.5, min = 0.0, max = 1.0)
+    tiles = EnumProperty(name = "Tiles", description="Bake in tiles to limit memory use, needs the NumPy post process and the minimal bake scene", default = "1",
+                                    items = (("1","None",""),
+                                            ("2", "2x2", ""),
+                                            ("4", "4x4", ""),
+                                            ("8","8x8","")))
 
     margin = IntProperty(name="Margin", default = 16, min = 0)
 
@@ -417,24 +1394,40 @@ class BakeJob(PropertyGroup):
     bakepasses = CollectionProperty(type=BakePass)
 
     def make_filename(self, context):
-        scene = context.scene
+        # names come from the scene the index was built on, the source scene during a bake
+        meltdown_atlas_index.ensure(context.scene)
+        # keyed on what the name is made of, atlas index rebuilds clear it
+        key = (meltdown_atlas_index.scene_name, tuple(pair.lowpoly for pair in self.pairs))
+        if key in meltdown_filenames:
+            return meltdown_filenames[key]
+
         filename = ""
         if len(self.pairs) > 1:
-            if hasattr(scene, "ms_lightmap_groups"):
-                textureAtlasGroupsNames = [group.name for group in scene.ms_lightmap_groups]
+            if meltdown_atlas_index.has_atlas:
                 for pair in self.pairs:
-                    for group in bpy.data.objects[pair.lowpoly].users_group:
-                        if group.name in textureAtlasGroupsNames:
-                            filename = bpy.path.clean_name(group.name, "_")
-                            break
+                    group = meltdown_atlas_index.get_group(pair.lowpoly)
+                    if group is not None:
+                        filename = bpy.path.clean_name(group, "_")
+                        break
             else:
-                for pair in self.pairs:
-                    filename += pair.lowpoly
-                    filename = "Atlas_" + hashlib.md5(filename.encode('utf-8')).hexdigest()
+                # stable whatever the pair order
+                lowpolys = "\n".join(sorted([pair.lowpoly for pair in self.pairs]))
+                filename = "Atlas_" + hashlib.md5(lowpolys.encode('utf-8')).hexdigest()
         else:
             filename = bpy.path.clean_name(self.pairs[0].lowpoly, "_")
+        meltdown_filenames[key] = filename
         return filename
 
+    def get_aa_factor(self):
+        if self.antialiasing == '0':
+            return 1
+        return int(self.antialiasing)
+
+    def get_filter_width(self):
+        if self.antialiasing == '0':
+            return 0.0
+        return (1.0-self.aa_sharpness)/2.0
+
     def get_render_resolution(self):
         if self.antialiasing == '0':
             return [self.resolutionX, self.resolutionY]
@@ -446,6 +1439,31 @@ class BakeJob(PropertyGroup):
 class MeltdownSettings(PropertyGroup):
     bl_idname = __name__
     jobs = CollectionProperty(type=BakeJob)
+    scene_builder = EnumProperty(name="Bake scene", description="How the temporary bake scene is built", default="MINIMAL",
+                                    items = (("MINIMAL","Minimal","Only copy the objects the bake depends on"),
+                                            ("FULL_COPY","Full copy","Copy the whole scene and remove unused objects")))
+    postprocess = EnumProperty(name="Post process", description="How margin and anti-aliasing are applied to the bake", default="NUMPY",
+                                    items = (("NUMPY","NumPy","Process the pixels directly and write the file"),
+                                            ("COMPOSITOR","Compositor","Render a compositor scene, slower")))
+    target_pool_limit = IntProperty(name="Target memory (MB)", description="Memory kept for bake target images between passes, 0 for no limit", default=4096, min=0)
+    use_cache = BoolProperty(name="Skip unchanged", description="Skip passes whose inputs and output file did not change since the last bake", default=True)
+    force_rebake = BoolProperty(name="Force rebake", description="Bake every pass, ignoring the bake cache", default=False)
+    pipeline = BoolProperty(name="Pipeline post process", description="Fill margins, downsample and write files in worker processes while the next pass bakes, NumPy post process only, needs fork (not on Windows)", default=False)
+    pipeline_queue = IntProperty(name="Queue", description="Finished passes waiting for the worker, the bake waits when the queue is full", default=2, min=1, max=16)
+    rasterize = BoolProperty(name="Rasterize data passes", description="Write UV, material ID and normal passes of lowpolys without highpoly straight from the meshes, without baking. Material ID uses the material viewport diffuse color, not the node color a bake gives", default=True)
+    derive_passes = BoolProperty(name="Derive composites", description="Compute combined and multi component passes from their component passes baked in the same job into float targets, NumPy post process only", default=True)
+    atlas_batch = BoolProperty(name="Batch atlas", description="Bake data passes (normals, colors, ids) of an atlas without highpoly in a single call", default=True)
+    atlas_batch_lit = BoolProperty(name="Batch lit", description="Also bake lit passes (lightmaps, AO, combined) of an atlas in a single call. Every lowpoly of the atlas is visible, so they shadow and light each other: right for an assembled scene, wrong for separate props", default=False)
+    dedupe = BoolProperty(name="Dedupe", description="Bake pairs and jobs with identical inputs once, copy the result for the others", default=False)
+    resume = BoolProperty(name="Resume", description="Skip passes finished by an interrupted bake, from its checkpoint", default=False)
+    use_modal = BoolProperty(name="Interactive", description="Keep the interface responsive while baking, ESC cancels and P pauses", default=True)
+    osd_rate = FloatProperty(name="Display rate", description="Progress display redraws per second, 0 turns the display off", default=4.0, min=0.0, max=60.0)
+    use_profiler = BoolProperty(name="Profile", description="Record the time spent in every bake phase", default=True)
+    profile_memory = BoolProperty(name="Peak memory", description="Record peak memory after every bake phase", default=False)
+    farm_workers = IntProperty(name="Farm workers", description="Number of background Blender processes baking at once", default=4, min=1)
+    farm_split = EnumProperty(name="Farm unit", description="How the work is spread across farm workers", default="JOB",
+                                    items = (("JOB","Job","One unit per job, passes of a job share a scene"),
+                                            ("PASS","Pass","One unit per pass of each job")))
 
 class MeltdownBakeOp(Operator):
     '''Process baking jobs'''
@@ -456,11 +1474,15 @@ class MeltdownBakeOp(Operator):
     job = IntProperty()
     bakepass = IntProperty()
     pair = IntProperty()
+    # farm workers only write files, materials are set up once by the farm
+    finish = BoolProperty(default=True, options={'SKIP_SAVE'})
+    # no osd, a failing pass does not stop the others
+    headless = BoolProperty(default=False, options={'SKIP_SAVE'})
 
     bake_all = BoolProperty()
     bake_target = StringProperty()
 
-    def create_temp_tex(self, bakepass, lowpoly, uvtex_name):
+    def create_temp_tex(self, bakepass, lowpoly, uvtex_name, target):
         print("create_temp_tex")
         tex = None
         no_materials = True
@@ -471,7 +1493,7 @@ class MeltdownBakeOp(Operator):
                 break;
 
         if no_materials:
-            temp_mat = bpy.data.materials.new("Meltdown_MD_TMP")
+            temp_mat = self.registry.add("materials", bpy.data.materials.new("Meltdown_MD_TMP"))
             # use nodes by default for cycles only
             temp_mat.use_nodes = bakepass.engine != "BLENDER_RENDER"
             lowpoly.data.materials.append(temp_mat)
@@ -482,7 +1504,7 @@ class MeltdownBakeOp(Operator):
                 if uvtex.name == uvtex_name:
                     uvtex.active = True
                     for d in uvtex.data:
-                        d.image = bpy.data.images["MDtarget"]
+                        d.image = target
         else:
             #add an image node to every lowpoly model's materials
             for bake_mat in lowpoly.data.materials:
@@ -499,7 +1521,7 @@ class MeltdownBakeOp(Operator):
                         bake_mat.node_tree.links.new(uvtex.outputs[0], tex.inputs[0])
                     else:
                         tex = bake_mat.node_tree.nodes["MDtarget"]
-                    tex.image = bpy.data.images["MDtarget"]
+                    tex.image = target
                     bake_mat.node_tree.nodes.active = tex
 
             if tex is not None:
@@ -507,60 +1529,84 @@ class MeltdownBakeOp(Operator):
                 bake_mat.node_tree.nodes.active = tex
 
     # 1
-    def create_render_target(self, job):
-        print("create_render_target")
+    def use_float_target(self, job, bakepass):
+        # components of derived passes add up light above 1, byte targets would clamp it,
+        # adaptive rounds measure noise in linear light, not in 8 bit steps
+        return job.output_format == 'OPEN_EXR' or bakepass.as_pointer() in self.components or \
+            self.use_adaptive(bakepass)
 
-        imageIdx = bpy.data.images.find("MDtarget")
-        if imageIdx > -1:
-            bpy.data.images.remove(bpy.data.images[imageIdx], do_unlink=True)
-
-        bpy.ops.image.new(name="MDtarget", width= job.get_render_resolution()[0], \
-        height = job.get_render_resolution()[1], \
-        color=(0.0, 0.0, 0.0, 0.0), alpha=True, generated_type='BLANK', float=False)
+    def create_render_target(self, job, bakepass):
+        print("create_render_target")
+        width, height = job.get_render_resolution()
+        return meltdown_target_pool.acquire(width, height, use_float=self.use_float_target(job, bakepass))
 
-    def cleanup_render_target(self, job, bakepass):
+    def cleanup_render_target(self, job, bakepass, baketarget):
         print("cleanup_render_target")
-        baketarget = bpy.data.images["MDtarget"]
-
-        # call compo trees here
-        self.compo_nodes_margin(job, bakepass, baketarget)
 
-        #unlink from image editors
-        for wm in bpy.data.window_managers:
-            for window in wm.windows:
-                for area in window.screen.areas:
-                    if area.type == "IMAGE_EDITOR":
-                        area.spaces[0].image = None
+        if self.settings.postprocess == 'NUMPY':
+            with meltdown_profiler.phase("postprocess_numpy"):
+                self.postprocess_numpy(job, bakepass, baketarget)
+        else:
+            # denoise before the compositor fills the margin
+            if bakepass.denoise > 0.0 and not bakepass.is_data_pass():
+                write_pixels(baketarget, self.denoise_pixels(job, bakepass, read_pixels(baketarget)))
+            # call compo trees here
+            with meltdown_profiler.phase("compo_nodes_margin"):
+                self.compo_nodes_margin(job, bakepass, baketarget)
 
-        bpy.data.images.remove(baketarget, do_unlink=True)
+        # keep the image around for the next pass
+        meltdown_target_pool.release(baketarget)
 
     # def apply_modifiers(self):
 
     # def merge_group(self):
-    def make_duplicates_real(self, scene, pair, object, highPolyGroup, oldMatrix, is_parentHipolyMember):
-        new_matrix = oldMatrix*object.matrix_world  #to store combination of parent groups matrices
-        for dupObj in object.dupli_group.objects:
+    def flatten_dupli_group(self, group):
+        # real objects instanced by a group, nested instances included, with their matrix
+        # relative to the instancing empty, computed once per bake run
+        # full copy groups are removed after each pair, the cache holds the original group objects
+        original = bpy.data.groups.get(group.get("md_orig_name", ""))
+        if original is not None and original != group:
+            group = original
+        if group.name in self.duplis:
+            return self.duplis[group.name]
+        offset = Matrix.Translation(-group.dupli_offset)
+        flat = []
+        for dupObj in group.objects:
             if dupObj.type == 'EMPTY' and dupObj.dupli_group:
-                self.make_duplicates_real(scene, pair, dupObj, highPolyGroup, new_matrix, is_parentHipolyMember)
+                #to store combination of parent groups matrices
+                for child, matrix in self.flatten_dupli_group(dupObj.dupli_group):
+                    flat.append((child, offset * dupObj.matrix_world * matrix))
             else:
-                copyDupObj = dupObj.copy()
-                copyDupObj.name += "_MD_TMP"
-                scene.objects.link(copyDupObj)
-                if is_parentHipolyMember: #if parent was in hipoly group/obj then link child to hipoly to
-                    highPolyGroup.objects.link(copyDupObj)
-                copyDupObj.matrix_world = new_matrix * copyDupObj.matrix_world
-
-
-    def scene_copy(self, scene, pair):
-        # store the original names of things in the scene so we can easily identify them later
+                flat.append((dupObj, offset * dupObj.matrix_world))
+        self.duplis[group.name] = flat
+        return flat
+
+    def make_duplicates_real(self, scene, object, group):
+        # copy the instanced objects of an empty into scene and group
+        for dupObj, matrix in self.flatten_dupli_group(object.dupli_group):
+            copyDupObj = dupObj.copy()
+            copyDupObj.name += "_MD_TMP"
+            self.registry.add("objects", copyDupObj)
+            scene.objects.link(copyDupObj)
+            group.objects.link(copyDupObj)
+            copyDupObj.matrix_world = object.matrix_world * matrix
+
+
+    def scene_copy(self, scene, pair, bakepass):
+        # store the original names of objects and groups so we can easily identify them later
+        groups = {}
         for object in scene.objects:
             object["md_orig_name"] = object.name
+            for group in object.users_group:
+                groups[group.name] = group
 
-        attrs = ["materials", "textures", "images", "groups", "worlds"]
-        for attr in attrs:
-            blocks = getattr(bpy.data, attr)
-            for block in blocks:
-                block["md_orig_name"] = block.name
+        for group in groups.values():
+            group["md_orig_name"] = group.name
+
+        # every datablock not found here afterwards is created by the copy
+        before = {}
+        for attr in self.registry.attrs:
+            before[attr] = set(getattr(bpy.data, attr).keys())
 
         # duplicate the scene
         bpy.ops.scene.new(type='FULL_COPY')
@@ -574,16 +1620,22 @@ class MeltdownBakeOp(Operator):
         for object in tmp_scene.objects:
             object.name = object["md_orig_name"] + "_MD_TMP"
 
-        for attr in attrs:
+        for attr in self.registry.attrs:
             blocks = getattr(bpy.data, attr)
-            for block in blocks:
-                if block["md_orig_name"] != block.name:
+            for name in set(blocks.keys()) - before[attr]:
+                block = blocks[name]
+                if attr == "groups" and "md_orig_name" in block:
                     block.name = block["md_orig_name"] + "_MD_TMP"
+                # unique name for world settings as we do use it when setting up scene
+                if attr == "worlds":
+                    block.name = "MD_TMP"
+                self.registry.add(attr, block)
 
-        # unique name for world settings as we do use it when setting up scene
-        for world in bpy.data.worlds:
-            if world["md_orig_name"] != world.name:
-                world.name = "MD_TMP"
+        for object in scene.objects:
+            del object["md_orig_name"]
+
+        for group in groups.values():
+            del group["md_orig_name"]
 
         highPolyGroup = None
 
@@ -591,24 +1643,229 @@ class MeltdownBakeOp(Operator):
             if pair.hp_obj_vs_group == "GRP":
                 highPolyGroup = bpy.data.groups[pair.highpoly+"_MD_TMP"]
             else:
-                highPolyGroup = bpy.data.groups.new(pair.highpoly+"_NoGroup_MD_TMP")  #create group with obj name
+                highPolyGroup = self.registry.add("groups", bpy.data.groups.new(pair.highpoly+"_NoGroup_MD_TMP"))  #create group with obj name
                 highPolyGroup.objects.link(tmp_scene.objects[pair.highpoly+"_MD_TMP"])
 
-        #make highpoly dupli instances real
-        for object in tmp_scene.objects:
+        environmentGroup = None
+        if not bakepass.clean_environment and not bakepass.environment_highpoly and bakepass.environment_group != "":
+            environmentGroup = bpy.data.groups.get(bakepass.environment_group + "_MD_TMP")
+
+        #make highpoly and environment dupli instances real, other instances are not baked
+        for object in list(tmp_scene.objects):
             if object.type == 'EMPTY' and object.dupli_group:
 
-                if pair.highpoly != "": #link obj's from group pro to hipoly group if obj is member of hipoly bake group
-                    if any(groupMember == object for groupMember in highPolyGroup.objects):
-                        self.make_duplicates_real(tmp_scene, pair, object, highPolyGroup, Matrix.Identity(4),True)  # true  = obj is in baking group (so childs should too)
-                    else:
-                        self.make_duplicates_real(tmp_scene, pair, object, highPolyGroup, Matrix.Identity(4),False)
+                if highPolyGroup is not None and object.name in highPolyGroup.objects:
+                    self.make_duplicates_real(tmp_scene, object, highPolyGroup)
+                elif environmentGroup is not None and object.name in environmentGroup.objects:
+                    self.make_duplicates_real(tmp_scene, object, environmentGroup)
 
                 tmp_scene.objects.unlink(object) #remove empty from baking
                 bpy.data.objects.remove(object, do_unlink=True)
 
         return tmp_scene, highPolyGroup
 
+    def set_context_scene(self, scene):
+        # there is no screen in background mode, ops get the scene through context_override
+        if bpy.context.screen is not None:
+            bpy.context.screen.scene = scene
+
+    def context_override(self, scene, active=None):
+        # context for ops running on the bake scene
+        if active is None:
+            active = scene.objects.active
+        override = bpy.context.copy()
+        override['scene'] = scene
+        override['active_object'] = active
+        override['object'] = active
+        selected = [object for object in scene.objects if object.select]
+        override['selected_objects'] = selected
+        override['selected_editable_objects'] = selected
+        return override
+
+    def copy_settings(self, src, dst):
+        # copy writable rna properties, pointers and collections are left alone
+        for prop in src.bl_rna.properties:
+            if prop.is_readonly or prop.type in {'POINTER', 'COLLECTION'}:
+                continue
+            try:
+                setattr(dst, prop.identifier, getattr(src, prop.identifier))
+            except (AttributeError, TypeError, ValueError):
+                # read only in this context or out of range
+                pass
+
+    def scene_build(self, scene, job, bakepasses, pairs):
+        # build a scene holding only the objects the job bakes depend on
+        tmp_scene = self.registry.add("scenes", bpy.data.scenes.new("MD_TMP"))
+        tmp_scene.layers[0] = True
+        self.copy_settings(scene.render, tmp_scene.render)
+        if hasattr(scene, "cycles"):
+            self.copy_settings(scene.cycles, tmp_scene.cycles)
+
+        # unique name for world settings as we do use it when setting up scene
+        if scene.world is not None:
+            world = scene.world.copy()
+        else:
+            world = bpy.data.worlds.new("MD_TMP")
+        world.name = "MD_TMP"
+        self.registry.add("worlds", world)
+        tmp_scene.world = world
+
+        session = MeltdownBakeSession(tmp_scene, pairs)
+
+        def link_copy(object):
+            if object.name in session.objects:
+                return session.objects[object.name]
+            copy = object.copy()
+            copy.name = object.name + "_MD_TMP"
+            self.registry.add("objects", copy)
+            tmp_scene.objects.link(copy)
+            session.objects[object.name] = copy
+            return copy
+
+        def copy_materials(copy):
+            # bake preparation edits mesh and materials, never touch the originals
+            copy.data = copy.data.copy()
+            self.registry.add_data(copy)
+            for i, mat in enumerate(copy.data.materials):
+                if mat is None:
+                    continue
+                if mat.name not in session.materials:
+                    session.materials[mat.name] = mat.copy()
+                    session.materials[mat.name].name = mat.name + "_MD_TMP"
+                    self.registry.add("materials", session.materials[mat.name])
+                copy.data.materials[i] = session.materials[mat.name]
+
+        def link_group(key, name, objects):
+            if key in session.groups:
+                return session.groups[key]
+            group = self.registry.add("groups", bpy.data.groups.new(name + "_MD_TMP"))
+            for object in objects:
+                if object.type == 'EMPTY' and object.dupli_group:
+                    self.make_duplicates_real(tmp_scene, object, group)
+                    continue
+                group.objects.link(link_copy(object))
+            session.groups[key] = group
+            return group
+
+        for pair in pairs:
+            lowpoly = link_copy(scene.objects[pair.lowpoly])
+            copy_materials(lowpoly)
+
+            if pair.cage != "":
+                link_copy(scene.objects[pair.cage])
+
+            if pair.highpoly != "":
+                if pair.hp_obj_vs_group == "GRP":
+                    group = link_group("GRP" + pair.highpoly, pair.highpoly, bpy.data.groups[pair.highpoly].objects)
+                else:
+                    group = link_group("OBJ" + pair.highpoly, pair.highpoly + "_NoGroup", [scene.objects[pair.highpoly]])
+                session.highpolys[pair.lowpoly] = group
+
+        for bakepass in bakepasses:
+            if bakepass.clean_environment:
+                continue
+            if bakepass.environment_highpoly:
+                for other in job.pairs:
+                    if other.highpoly != "" and other.hp_obj_vs_group == "OBJ" and scene.objects.find(other.highpoly) > -1:
+                        link_copy(scene.objects[other.highpoly])
+            elif bakepass.environment_group != "":
+                link_group("ENV" + bakepass.environment_group, bakepass.environment_group, \
+                    bpy.data.groups[bakepass.environment_group].objects)
+
+        # From here, context.scene is "MD_TMP"
+        self.set_context_scene(tmp_scene)
+
+        # apply multires once for the whole job
+        for pair in pairs:
+            meltdown_profiler.tag(pair=pair.lowpoly)
+            with meltdown_profiler.phase("prepare_multires"):
+                highpoly = self.prepare_multires(tmp_scene, job, bakepasses[0], pair)
+            if highpoly is not None:
+                group = self.registry.add("groups", bpy.data.groups.new(highpoly.name))
+                group.objects.link(highpoly)
+                session.highpolys[pair.lowpoly] = group
+            pair.use_hipoly = pair.lowpoly in session.highpolys
+
+        # nothing renders until a pair bake asks for it
+        for object in tmp_scene.objects:
+            object.select = False
+            object.hide_render = True
+
+        return session
+
+    def session_objects(self, session, job, bakepass, pair):
+        # objects used by this pair bake
+        objects = [session.objects[pair.lowpoly]]
+        if pair.lowpoly in session.highpolys:
+            objects.extend(session.highpolys[pair.lowpoly].objects)
+
+        if not bakepass.clean_environment:
+            if bakepass.environment_highpoly:
+                for other in job.pairs:
+                    if other.hp_obj_vs_group == "OBJ" and other.highpoly in session.objects:
+                        objects.append(session.objects[other.highpoly])
+            elif bakepass.environment_group != "":
+                objects.extend(session.groups["ENV" + bakepass.environment_group].objects)
+        return objects
+
+    def session_show_objects(self, session, objects):
+        # swap visibility and selection to these objects
+        scene = session.scene
+        visible = set(object.name for object in objects)
+        for name in session.visible - visible:
+            object = scene.objects[name]
+            object.select = False
+            object.hide_render = True
+        for object in objects:
+            self.use_object(object)
+        session.visible = visible
+
+    def session_show(self, session, job, bakepass, pair):
+        # swap visibility and selection to the objects used by this pair bake
+        self.session_show_objects(session, self.session_objects(session, job, bakepass, pair))
+        session.scene.objects.active = session.objects[pair.lowpoly]
+
+    def material_id_override(self, mat):
+        override = self.registry.add("materials", bpy.data.materials.new(mat.name + "_MATID_MD_TMP"))
+        override.use_nodes = True
+        tree = override.node_tree
+
+        for node in tree.nodes:
+            tree.nodes.remove(node)
+
+        tree.nodes.new(type = "ShaderNodeBsdfDiffuse")
+        tree.nodes.new(type = "ShaderNodeOutputMaterial")
+        output = tree.nodes["Diffuse BSDF"].outputs["BSDF"]
+        input = tree.nodes["Material Output"].inputs["Surface"]
+        tree.links.new(output, input)
+
+        tree.nodes["Diffuse BSDF"].inputs["Color"].default_value = \
+        [mat.diffuse_color[0], mat.diffuse_color[1], mat.diffuse_color[2], 1]
+        return override
+
+    def pass_material_id_swap(self, session, bakepass):
+        # highpoly copies share their data with the originals,
+        # so material id overrides are linked at object level
+        use_material_id = bakepass.pass_name == "MAT_ID"
+        if use_material_id == session.use_material_id:
+            return
+
+        for group in set(session.highpolys.values()):
+            for object in group.objects:
+                for slot in object.material_slots:
+                    if use_material_id:
+                        mat = slot.material
+                        if mat is None:
+                            continue
+                        if mat.name not in session.material_id:
+                            session.material_id[mat.name] = self.material_id_override(mat)
+                        slot.link = 'OBJECT'
+                        slot.material = session.material_id[mat.name]
+                    else:
+                        slot.link = 'DATA'
+
+        session.use_material_id = use_material_id
+
     def copy_engine_settings(self, scene, job, bakepass):
         #copy pass settings to cycles settings
 
@@ -616,7 +1873,7 @@ class MeltdownBakeOp(Operator):
             bake_type, pass_filter = bakepass.get_cycles_pass_type()
             scene.cycles.bake_type = bake_type
             scene.cycles.samples = bakepass.samples
-            bpy.data.worlds["MD_TMP"].light_settings.distance = bakepass.ao_distance
+            scene.world.light_settings.distance = bakepass.ao_distance
 
         if bakepass.engine == 'BLENDER_RENDER':
             scene.render.bake_type = bakepass.pass_name
@@ -648,32 +1905,36 @@ class MeltdownBakeOp(Operator):
                 [mat.diffuse_color[0], mat.diffuse_color[1], mat.diffuse_color[2], 1]
 
 
-        if pair.highpoly != "":
+        if highPolyGroup is not None:
             for object in highPolyGroup.objects:
                 change_material(object)
 
 
     def prepare_multires(self, scene, job, bakepass, pair):
         # Build a highpoly setup from lowpoly with multires modifier
+        # return the highpoly object if any
 
         object = scene.objects[pair.lowpoly+"_MD_TMP"]
         for mod in object.modifiers:
             if mod.type == 'MULTIRES':
-                pair.use_hipoly = True
                 highpoly = object.copy()
                 highpoly.data = object.data.copy()
-                pair.highpoly = pair.lowpoly + "_MULTIRES_HI"
-                highpoly.name = pair.highpoly + "_MD_TMP"
+                highpoly.name = pair.lowpoly + "_MULTIRES_HI_MD_TMP"
+                self.registry.add("objects", highpoly)
+                self.registry.add_data(highpoly)
                 scene.objects.link(highpoly)
                 for himod in highpoly.modifiers:
                     if himod.type == 'MULTIRES':
                         himod.levels = max(mod.levels, mod.sculpt_levels, mod.render_levels)
                         scene.objects.active = highpoly
-                        bpy.ops.object.modifier_apply( modifier=himod.name)
-            # setup lowpoly modifier
-            mod.levels = min(mod.levels, mod.sculpt_levels, mod.render_levels)
-            bpy.ops.object.modifier_apply( modifier=mod.name)
-            #mod.render_level = mod.level
+                        bpy.ops.object.modifier_apply(self.context_override(scene, highpoly), modifier=himod.name)
+                # setup lowpoly modifier
+                mod.levels = min(mod.levels, mod.sculpt_levels, mod.render_levels)
+                scene.objects.active = object
+                bpy.ops.object.modifier_apply(self.context_override(scene, object), modifier=mod.name)
+                #mod.render_level = mod.level
+                return highpoly
+        return None
 
     def use_object(self, object):
         object.hide = False
@@ -690,7 +1951,7 @@ class MeltdownBakeOp(Operator):
         # make selections, ensure visibility
         bpy.ops.object.select_all(action='DESELECT')
 
-        if pair.highpoly != "":
+        if highPolyGroup is not None:
             for object in highPolyGroup.objects:
                 self.use_object(object)
         else:
@@ -729,27 +1990,24 @@ class MeltdownBakeOp(Operator):
             self.pass_material_id_prep(scene, pair, highPolyGroup)
 
     # 3 bake a pair
-    def bake_set(self, scene, job, bakepass, pair):
+    def get_uvtex_name(self, name):
+        # Check for texture atlas group membership of the source object, by the pair lowpoly name,
+        # copies in the bake scene may be renamed or truncated
+        return meltdown_atlas_index.get_uvtex_name(name)
+
+    def bake_set(self, scene, job, bakepass, pair, target, lowpoly=None):
         print("bake_set")
         no_materials = False
 
-        #ensure lowpoly has material
-        lowpoly = scene.objects[pair.lowpoly+"_MD_TMP"]
+        #ensure lowpoly has material, bake sessions pass their copy of the lowpoly
+        if lowpoly is None:
+            lowpoly = scene.objects[pair.lowpoly+"_MD_TMP"]
 
         lowpoly.select = True
         scene.objects.active = lowpoly
 
-        # Check for texture atlas group membership
-        # and use group name as uvtex_name if any
-        uvtex_name = 'Auto-Unwrap'
-        if hasattr(scene, "ms_lightmap_groups"):
-            textureAtlasGroupsNames = [group.name for group in scene.ms_lightmap_groups]
-            for group in lowpoly.users_group:
-                if group.name in textureAtlasGroupsNames:
-                    uvtex_name = group.name
-                    break
-
-        self.create_temp_tex(bakepass, lowpoly, uvtex_name)
+        uvtex_name = self.get_uvtex_name(pair.lowpoly)
+        self.create_temp_tex(bakepass, lowpoly, uvtex_name, target)
 
         if pair.extrusion_vs_cage == "CAGE":
             pair_use_cage = True
@@ -762,21 +2020,57 @@ class MeltdownBakeOp(Operator):
         bakepass.pair_counter = bakepass.pair_counter + 1
 
         #bake
+        self.bake_call(scene, job, bakepass, lowpoly, clear, pair.use_hipoly, pair.extrusion, pair.cage, pair_use_cage)
 
+    def bake_call(self, scene, job, bakepass, active, clear, selected_to_active=False, extrusion=0.0, cage="", use_cage=False):
         if bakepass.engine == 'BLENDER_RENDER':
-            bpy.ops.object.bake_image()
+            scene.render.use_bake_clear = clear
+            bpy.ops.object.bake_image(self.context_override(scene, active))
 
         if bakepass.engine == 'CYCLES':
             bake_type, pass_filter = bakepass.get_cycles_pass_type()
-            bpy.ops.object.bake(type=bake_type, pass_filter=pass_filter, \
+            bpy.ops.object.bake(self.context_override(scene, active), type=bake_type, pass_filter=pass_filter, \
             filepath="", \
             width=job.get_render_resolution()[0], height=job.get_render_resolution()[1], margin=job.margin, \
-            use_selected_to_active=pair.use_hipoly, cage_extrusion=pair.extrusion, cage_object=pair.cage, \
+            use_selected_to_active=selected_to_active, cage_extrusion=extrusion, cage_object=cage, \
             normal_space=bakepass.nm_space, \
             normal_r=bakepass.normal_r, normal_g=bakepass.normal_g, normal_b=bakepass.normal_b, \
-            save_mode='INTERNAL', use_clear=clear, use_cage=pair_use_cage, \
+            save_mode='INTERNAL', use_clear=clear, use_cage=use_cage, \
             use_split_materials=False, use_automatic_name=False)
 
+    def can_bake_batch(self, session, bakepass):
+        # only plain atlases, selected to active needs one call per highpoly,
+        # lit passes on request: the other lowpolys of the atlas shadow them
+        return self.settings.atlas_batch and len(session.pairs) > 1 and len(session.highpolys) < 1 and \
+            (bakepass.is_data_pass() or self.settings.atlas_batch_lit)
+
+    def bake_batch(self, session, job, bakepass, target, pairs):
+        # every lowpoly of the atlas bakes into the shared target in one call,
+        # so the render engine syncs the scene and builds its BVH once per pass
+        print("bake_batch")
+        scene = session.scene
+
+        objects = []
+        for pair in pairs:
+            for object in self.session_objects(session, job, bakepass, pair):
+                if object not in objects:
+                    objects.append(object)
+        self.session_show_objects(session, objects)
+
+        # environment stays visible for lighting, only lowpolys are baked
+        for object in objects:
+            object.select = False
+        lowpolys = [session.objects[pair.lowpoly] for pair in pairs]
+        for pair, lowpoly in zip(pairs, lowpolys):
+            lowpoly.select = True
+            self.create_temp_tex(bakepass, lowpoly, self.get_uvtex_name(pair.lowpoly), target)
+        scene.objects.active = lowpolys[0]
+
+        if bakepass.engine == 'BLENDER_RENDER':
+            scene.render.use_bake_selected_to_active = False
+        bakepass.pair_counter = len(pairs)
+        self.bake_call(scene, job, bakepass, lowpolys[0], True)
+
 
     # 2
     def bake_pass(self, context, progress, src_scene, job, bakepass):
@@ -795,7 +2089,7 @@ class MeltdownBakeOp(Operator):
         bpy.ops.meltdown.switch_materials(engine=bakepass.engine, link='DATA',all_objects=False)
 
         progress.enter_substeps(len(pairs))
-        self.create_render_target(job)
+        target = self.create_render_target(job, bakepass)
 
         for pair in pairs:
 
@@ -805,19 +2099,863 @@ class MeltdownBakeOp(Operator):
             if context.area is not None:
                 context.area.tag_redraw()
 
-            tmp_scene, highPolyGroup = self.scene_copy(src_scene, pair)
+            meltdown_profiler.tag(pair=pair.lowpoly)
+            with meltdown_profiler.phase("scene_copy"):
+                tmp_scene, highPolyGroup = self.scene_copy(src_scene, pair, bakepass)
+
+            with meltdown_profiler.phase("prepare_multires"):
+                highpoly = self.prepare_multires(tmp_scene, job, bakepass, pair)
+            if highpoly is not None:
+                highPolyGroup = self.registry.add("groups", bpy.data.groups.new(highpoly.name))
+                highPolyGroup.objects.link(highpoly)
+                pair.use_hipoly = True
+            with meltdown_profiler.phase("prepare_scene"):
+                self.prepare_scene(tmp_scene, job, bakepass, pair, highPolyGroup)
+            with meltdown_profiler.phase("bake_set"):
+                self.bake_set(tmp_scene, job, bakepass, pair, target)
+            # update context (attempt to prevent ACCESS_VIOLATION on scenes.remove() 2.78a windows 10)
+            bpy.context.screen.scene = src_scene
+            with meltdown_profiler.phase("cleanup"):
+                self.cleanup(tmp_scene)
+
+            # one pair bake done, give the modal operator a chance to run
+            yield
+
+        meltdown_profiler.tag(pair="")
+
+        # out of pairs loop to support Atlas mode
+        self.cleanup_render_target(job, bakepass, target)
+
+        progress.leave_substeps()
+
+    def bake_session_pass(self, context, progress, session, job, bakepass):
+        print("bake_session_pass")
+        bakepass.pair_counter = 0
+        scene = session.scene
+
+        # make sure the bake scene is the context scene
+        self.set_context_scene(scene)
+
+        # swap the state this pass needs
+        with meltdown_profiler.phase("pass_setup"):
+            self.copy_engine_settings(scene, job, bakepass)
+            bpy.ops.meltdown.switch_materials(self.context_override(scene), engine=bakepass.engine, link='DATA',all_objects=False)
+            self.pass_material_id_swap(session, bakepass)
+
+        if int(job.tiles) > 1 and self.settings.postprocess == 'NUMPY':
+            yield from self.bake_session_tiles(context, progress, session, job, bakepass)
+            return
+
+        target = self.create_render_target(job, bakepass)
+        pairs = self.dedupe_pairs(job, bakepass, session.pairs)
+
+        if self.use_adaptive(bakepass):
+            yield from self.bake_adaptive(scene, job, bakepass, target,
+                lambda: self.bake_session_round(context, progress, session, job, bakepass, target, pairs))
+        else:
+            yield from self.bake_session_round(context, progress, session, job, bakepass, target, pairs)
+
+        # out of pairs loop to support Atlas mode
+        self.cleanup_render_target(job, bakepass, target)
+
+    def bake_session_round(self, context, progress, session, job, bakepass, target, pairs, label=""):
+        scene = session.scene
+
+        if self.can_bake_batch(session, bakepass):
+            progress.enter_substeps(1)
+            progress.step()
+            meltdown_osd.update(progress, obj=("Objects: %d%s" % (len(pairs), label)), passe=("Pass: %s" % (bakepass.pass_name)))
+            with meltdown_profiler.phase("bake_batch"):
+                self.bake_batch(session, job, bakepass, target, pairs)
+            yield
+            progress.leave_substeps()
+            return
+
+        progress.enter_substeps(len(pairs))
+
+        for pair in pairs:
+
+            progress.step()
+            meltdown_osd.update(progress, obj=("Object: %s%s" % (pair.lowpoly, label)), passe=("Pass: %s" % (bakepass.pass_name)))
+
+            if context.area is not None:
+                context.area.tag_redraw()
+
+            meltdown_profiler.tag(pair=pair.lowpoly)
+            with meltdown_profiler.phase("session_show"):
+                self.session_show(session, job, bakepass, pair)
+            with meltdown_profiler.phase("bake_set"):
+                self.bake_set(scene, job, bakepass, pair, target, session.objects[pair.lowpoly])
+            yield
+
+        meltdown_profiler.tag(pair="")
+
+        progress.leave_substeps()
+
+    def use_adaptive(self, bakepass):
+        # data passes come out the same with any seed
+        return bakepass.adaptive and bakepass.engine == 'CYCLES' and not bakepass.is_data_pass()
+
+    def bake_adaptive(self, scene, job, bakepass, target, bake_round, report=True):
+        # bake rounds of bakepass.samples with a new seed each, until the noise of their mean
+        # is under the threshold or the sample limit or time budget is reached
+        print("bake_adaptive")
+        seed = scene.cycles.seed
+        start = time.time()
+        rounds = 0
+        mean = None
+        try:
+            while True:
+                scene.cycles.seed = seed + rounds
+                # each round clears the target
+                bakepass.pair_counter = 0
+                yield from bake_round()
+
+                with meltdown_profiler.phase("adaptive_noise"):
+                    pixels = read_pixels(target)
+                    rounds += 1
+                    if mean is None:
+                        mean = pixels
+                        m2 = numpy.zeros_like(pixels[:, :, :3])
+                    else:
+                        # running mean and variance between rounds
+                        delta = pixels[:, :, :3] - mean[:, :, :3]
+                        mean += (pixels - mean) / rounds
+                        m2 += delta * (pixels[:, :, :3] - mean[:, :, :3])
+                    noise = None
+                    if rounds > 1:
+                        # standard error of the mean, a few fireflies do not hold the pass back
+                        error = numpy.sqrt(numpy.maximum.reduce(m2, axis=2) / ((rounds - 1) * rounds))
+                        covered = mean[:, :, 3] > 0.0
+                        noise = 0.0
+                        if covered.any():
+                            noise = float(numpy.percentile(error[covered], 99))
+
+                samples = rounds * bakepass.samples
+                print("adaptive round %d, %d samples, noise %s" % (rounds, samples, noise))
+                if noise is not None and noise <= bakepass.noise_threshold:
+                    break
+                if samples + bakepass.samples > bakepass.max_samples:
+                    break
+                # stop when one more round would run past the budget
+                if bakepass.time_budget > 0.0 and (time.time() - start) / rounds * (rounds + 1) > bakepass.time_budget:
+                    break
+        finally:
+            scene.cycles.seed = seed
+
+        write_pixels(target, mean)
+        # tiles of one pass converge separately, keep the most samples any of them took
+        filepath = bpy.path.abspath(bakepass.get_filepath(job))
+        self.samples_used[filepath] = max(samples, self.samples_used.get(filepath, 0))
+        if report:
+            self.report({'INFO'}, "%s: %d samples" % (bakepass.get_filename(job), samples))
+
+    def session_uvs(self, session, pair):
+        # bake uv layer of the lowpoly copy, and its original coordinates
+        if pair.lowpoly not in session.uvs:
+            lowpoly = session.objects[pair.lowpoly]
+            mesh = lowpoly.data
+            uv_layer = mesh.uv_layers.get(self.get_uvtex_name(pair.lowpoly))
+            if uv_layer is None:
+                uv_layer = mesh.uv_layers.active
+            uvs = numpy.empty(len(mesh.loops) * 2, dtype=numpy.float32)
+            uv_layer.data.foreach_get("uv", uvs)
+            session.uvs[pair.lowpoly] = (uv_layer.name, uvs.reshape(-1, 2))
+        return session.uvs[pair.lowpoly]
+
+    def set_uvs(self, session, pair, uvs):
+        name, orig = self.session_uvs(session, pair)
+        session.objects[pair.lowpoly].data.uv_layers[name].data.foreach_set("uv", uvs.ravel())
+
+    def bake_session_tiles(self, context, progress, session, job, bakepass):
+        # bake the uv space tile by tile at render resolution,
+        # each tile is post processed and copied into the final image right away
+        print("bake_session_tiles")
+        factor = job.get_aa_factor()
+        width, height = job.resolutionX, job.resolutionY
+        # at least one pixel per tile
+        tiles = max(1, min(int(job.tiles), width, height))
+        tile_w = -(-width // tiles)
+        tile_h = -(-height // tiles)
+        # tiles overlap by the margin so it is filled across tile borders
+        pad = job.margin + 1
+        size = numpy.array([width, height], dtype=numpy.float32)
+
+        final = numpy.zeros((height, width, 4), dtype=numpy.float32)
+
+        progress.enter_substeps(tiles * tiles)
+
+        for ty in range(tiles):
+            for tx in range(tiles):
+                progress.step()
+                # rounded up tile sizes may leave the last tiles out of the image
+                if tx * tile_w >= width or ty * tile_h >= height:
+                    continue
+                origin = numpy.array([tx * tile_w - pad, ty * tile_h - pad], dtype=numpy.float32)
+                extent = numpy.array([tile_w + 2 * pad, tile_h + 2 * pad], dtype=numpy.float32)
+
+                pairs = []
+                for pair in session.pairs:
+                    name, uvs = self.session_uvs(session, pair)
+                    if len(uvs) < 1:
+                        continue
+                    pixels = uvs * size - origin
+                    if (pixels.max(axis=0) < 0.0).any() or (pixels.min(axis=0) > extent).any():
+                        continue
+                    self.set_uvs(session, pair, pixels / extent)
+                    pairs.append(pair)
+
+                if len(pairs) < 1:
+                    continue
+
+                target = meltdown_target_pool.acquire(int(extent[0]) * factor, int(extent[1]) * factor, \
+                    use_float=self.use_float_target(job, bakepass))
+                bakepass.pair_counter = 0
+                pairs = self.dedupe_pairs(job, bakepass, pairs)
+                label = " tile %d/%d" % (ty * tiles + tx + 1, tiles * tiles)
+
+                # same rounds as an untiled pass, batching included, each tile converges on its own
+                bake_round = lambda: self.bake_session_round(context, progress, session, job, bakepass, target, pairs, label)
+                if self.use_adaptive(bakepass):
+                    yield from self.bake_adaptive(session.scene, job, bakepass, target, bake_round, report=False)
+                else:
+                    yield from bake_round()
+
+                with meltdown_profiler.phase("postprocess_tile"):
+                    pixels = read_pixels(target)
+                    meltdown_target_pool.release(target)
+                    pixels = self.denoise_pixels(job, bakepass, pixels, origin, extent)
+                    pixels = dilate_margin(pixels, job.margin * factor)
+                    pixels = downsample(pixels, factor, job.get_filter_width())
+
+                x0, y0 = tx * tile_w, ty * tile_h
+                x1, y1 = min(x0 + tile_w, width), min(y0 + tile_h, height)
+                final[y0:y1, x0:x1] = pixels[pad:pad + y1 - y0, pad:pad + x1 - x0]
+
+        # restore uvs for the next passes
+        for pair in session.pairs:
+            name, uvs = self.session_uvs(session, pair)
+            self.set_uvs(session, pair, uvs)
+
+        self.save_pixels(job, bakepass, final, linear=self.use_float_target(job, bakepass))
+        if self.use_adaptive(bakepass):
+            filepath = bpy.path.abspath(bakepass.get_filepath(job))
+            self.report({'INFO'}, "%s: up to %d samples per tile" % (bakepass.get_filename(job), self.samples_used.get(filepath, 0)))
+
+        progress.leave_substeps()
+
+    def job_key(self, job):
+        # hash of the job settings, pairs and their objects, meshes are hashed once for every pass of the job
+        key = job.as_pointer()
+        if key not in self.job_keys:
+            md5 = hashlib.md5()
+            md5.update(("job:%s:%s:%s:%s:%s:%s;" % (job.resolutionX, job.resolutionY, job.antialiasing,
+                job.aa_sharpness, job.margin, job.output_format)).encode('utf-8'))
+            done = set()
+            for pair in job.pairs:
+                if not pair.activated:
+                    continue
+                hash_rna(md5, pair, skip={'use_hipoly'})
+                hash_object(md5, bpy.data.objects.get(pair.lowpoly), done)
+                if pair.cage != "":
+                    hash_object(md5, bpy.data.objects.get(pair.cage), done)
+                if pair.highpoly != "":
+                    if pair.hp_obj_vs_group == "GRP":
+                        group = bpy.data.groups.get(pair.highpoly)
+                        if group is not None:
+                            for object in group.objects:
+                                hash_object(md5, object, done)
+                    else:
+                        hash_object(md5, bpy.data.objects.get(pair.highpoly), done)
+            self.job_keys[key] = md5.hexdigest()
+        return self.job_keys[key]
+
+    def objects_key(self, key, objects):
+        # hash of environment objects, shared by the passes using them
+        if key not in self.object_keys:
+            md5 = hashlib.md5()
+            done = set()
+            for object in objects:
+                hash_object(md5, object, done)
+            self.object_keys[key] = md5.hexdigest()
+        return self.object_keys[key]
+
+    def pass_key(self, scene, job, bakepass):
+        # hash of everything the output file of this pass depends on
+        md5 = hashlib.md5()
+        hash_rna(md5, bakepass, skip={'activated', 'pair_counter'})
+        md5.update(self.job_key(job).encode('utf-8'))
+        # settings choosing how the pass is produced
+        md5.update(("settings:%s:%s:%s:%s;" % (self.settings.rasterize, self.settings.postprocess,
+            self.settings.derive_passes, self.settings.atlas_batch and self.settings.atlas_batch_lit)).encode('utf-8'))
+
+        if not bakepass.clean_environment:
+            if bakepass.environment_highpoly:
+                highpolys = [bpy.data.objects.get(other.highpoly) for other in job.pairs
+                    if other.highpoly != "" and other.hp_obj_vs_group == "OBJ"]
+                md5.update(self.objects_key(("highpolys", job.as_pointer()), highpolys).encode('utf-8'))
+            elif bakepass.environment_group != "":
+                group = bpy.data.groups.get(bakepass.environment_group)
+                if group is not None:
+                    md5.update(self.objects_key(("group", group.name), group.objects).encode('utf-8'))
+            if scene.world is not None:
+                hash_rna(md5, scene.world)
+                hash_rna(md5, scene.world.light_settings)
+                if scene.world.use_nodes:
+                    hash_node_tree(md5, scene.world.node_tree)
+
+        if bakepass.material_override != "":
+            hash_material(md5, bpy.data.materials.get(bakepass.material_override))
+
+        return md5.hexdigest()
+
+    def pair_signature(self, job, bakepass, pair):
+        # inputs of a pair bake that do not depend on where the pair sits in the scene,
+        # None when the pass sees the scene around the pair
+        is_data = bakepass.is_data_pass()
+        if not is_data and not bakepass.clean_environment:
+            return None
+        lowpoly = bpy.data.objects.get(pair.lowpoly)
+        if lowpoly is None or lowpoly.data is None:
+            return None
+
+        md5 = hashlib.md5()
+        inverse = lowpoly.matrix_world.inverted()
+
+        def add_object(object):
+            # shared data, placement relative to the lowpoly, object level materials and modifiers
+            if object.data is not None:
+                md5.update(("data:%s;" % object.data.name).encode('utf-8'))
+            elif object.dupli_group is not None:
+                md5.update(("dupli:%s;" % object.dupli_group.name).encode('utf-8'))
+            else:
+                return False
+            relative = inverse * object.matrix_world
+            md5.update(repr([round(v, 5) for row in relative for v in row]).encode('utf-8'))
+            for slot in object.material_slots:
+                if slot.link == 'OBJECT' and slot.material is not None:
+                    md5.update(("material:%s;" % slot.material.name).encode('utf-8'))
+            for mod in object.modifiers:
+                hash_rna(md5, mod)
+            return True
+
+        hash_rna(md5, pair, skip={'activated', 'use_hipoly', 'lowpoly', 'highpoly', 'cage'})
+        add_object(lowpoly)
+        if not is_data:
+            # world lighting depends on orientation
+            md5.update(repr([round(v, 5) for row in lowpoly.matrix_world.to_3x3() for v in row]).encode('utf-8'))
+
+        if pair.highpoly != "":
+            if pair.hp_obj_vs_group == "GRP":
+                group = bpy.data.groups.get(pair.highpoly)
+                if group is None:
+                    return None
+                objects = list(group.objects)
+            else:
+                objects = [bpy.data.objects.get(pair.highpoly)]
+            for object in sorted(objects, key=lambda object: object.name if object is not None else ""):
+                if object is None or not add_object(object):
+                    return None
+
+        if pair.cage != "":
+            cage = bpy.data.objects.get(pair.cage)
+            if cage is None or not add_object(cage):
+                return None
+
+        # environment objects are selected with the pair, data passes included
+        if not bakepass.clean_environment:
+            environment = []
+            if bakepass.environment_highpoly:
+                environment = [bpy.data.objects.get(other.highpoly) for other in job.pairs
+                    if other.highpoly != "" and other.hp_obj_vs_group == "OBJ"]
+            elif bakepass.environment_group != "":
+                group = bpy.data.groups.get(bakepass.environment_group)
+                if group is None:
+                    return None
+                environment = list(group.objects)
+            for object in sorted(environment, key=lambda object: object.name if object is not None else ""):
+                if object is None or not add_object(object):
+                    return None
+
+        return md5.hexdigest()
+
+    def job_signature(self, job, bakepass):
+        # identical for jobs whose pass output would be the same file content
+        pairs = [pair for pair in job.pairs if pair.activated]
+        signatures = [self.pair_signature(job, bakepass, pair) for pair in pairs]
+        if len(signatures) < 1 or None in signatures:
+            return None
+        md5 = hashlib.md5()
+        hash_rna(md5, bakepass, skip={'activated', 'pair_counter'})
+        md5.update(("job:%s:%s:%s:%s:%s:%s:%s;" % (job.resolutionX, job.resolutionY, job.antialiasing,
+            job.aa_sharpness, job.margin, job.output_format, job.tiles)).encode('utf-8'))
+        for signature in sorted(signatures):
+            md5.update(signature.encode('utf-8'))
+        return md5.hexdigest()
+
+    def dedupe_pairs(self, job, bakepass, pairs):
+        # pairs sharing lowpoly data cover the same texels, the first one is enough
+        if not self.settings.dedupe:
+            return pairs
+        unique = []
+        seen = set()
+        for pair in pairs:
+            signature = self.pair_signature(job, bakepass, pair)
+            if signature is not None:
+                if signature in seen:
+                    print("skip duplicate pair %s" % pair.lowpoly)
+                    continue
+                seen.add(signature)
+            unique.append(pair)
+        return unique
+
+    def copy_pass(self, scene, job, bakepass, src, filepath):
+        # reuse the file of an identical pass baked earlier in this run
+        print("copy duplicate %s" % filepath)
+        shutil.copyfile(src, filepath)
+        if self.settings.use_cache:
+            self.cache.store(filepath, self.pass_key(scene, job, bakepass))
+        self.summary['passes'].append({'job': job.make_filename(bpy.context), 'pass': bakepass.get_pass_fullname(),
+            'file': filepath, 'time': 0.0, 'skipped': True, 'error': "", 'samples': 0})
+        self.summary['files'].append(filepath)
+        if self.checkpoint is not None:
+            self.checkpoint.add(filepath)
+
+    def perturbs_normal(self, tree, done):
+        # shading normals leave the mesh normals as soon as anything feeds a normal or displacement input
+        if tree is None or tree.name in done:
+            return False
+        done.add(tree.name)
+        for link in tree.links:
+            if link.to_socket.name in ["Normal", "Displacement"]:
+                return True
+        for node in tree.nodes:
+            if node.type == 'GROUP' and self.perturbs_normal(node.node_tree, done):
+                return True
+        return False
+
+    def can_rasterize(self, src_scene, job, bakepass):
+        # passes read straight from the lowpoly meshes, nothing to trace without a highpoly
+        if not self.settings.rasterize or bakepass.engine != 'CYCLES':
+            return False
+        if bakepass.pass_name not in ["UV", "MAT_ID", "NORMAL"]:
+            return False
+        pairs = [pair for pair in job.pairs if pair.activated]
+        if len(pairs) < 1:
+            return False
+        for pair in pairs:
+            if pair.highpoly != "":
+                return False
+            lowpoly = src_scene.objects.get(pair.lowpoly)
+            if lowpoly is None or lowpoly.type != 'MESH':
+                return False
+            for mod in lowpoly.modifiers:
+                if mod.type == 'MULTIRES':
+                    return False
+            if bakepass.pass_name == "NORMAL":
+                done = set()
+                for slot in lowpoly.material_slots:
+                    if slot.material is not None and slot.material.use_nodes and \
+                        self.perturbs_normal(slot.material.node_tree, done):
+                        return False
+        return True
+
+    def mesh_triangles(self, name, mesh):
+        # bake uv coordinates of the loops, polygon and loops of each triangle, None without uvs,
+        # name of the pair lowpoly
+        uv_layer = mesh.uv_layers.get(self.get_uvtex_name(name))
+        if uv_layer is None:
+            uv_layer = mesh.uv_layers.active
+        if uv_layer is None:
+            return None
+
+        loop_uvs = numpy.empty(len(mesh.loops) * 2, dtype=numpy.float32)
+        uv_layer.data.foreach_get("uv", loop_uvs)
+        loop_uvs = loop_uvs.reshape(-1, 2)
+
+        # fan triangulation of the polygons
+        starts = numpy.empty(len(mesh.polygons), dtype=numpy.int64)
+        totals = numpy.empty(len(mesh.polygons), dtype=numpy.int64)
+        mesh.polygons.foreach_get("loop_start", starts)
+        mesh.polygons.foreach_get("loop_total", totals)
+        fans = numpy.maximum(totals - 2, 0)
+        poly = numpy.repeat(numpy.arange(len(starts)), fans)
+        fan = numpy.arange(len(poly)) - numpy.repeat(numpy.cumsum(fans) - fans, fans) + 1
+        corners = numpy.stack((starts[poly], starts[poly] + fan, starts[poly] + fan + 1), axis=1)
+        return loop_uvs, poly, corners
+
+    def uv_islands(self, mesh, loop_uvs):
+        # island index of each polygon, polygons meeting at a vertex with the same uv are connected
+        starts = numpy.empty(len(mesh.polygons), dtype=numpy.int64)
+        totals = numpy.empty(len(mesh.polygons), dtype=numpy.int64)
+        mesh.polygons.foreach_get("loop_start", starts)
+        mesh.polygons.foreach_get("loop_total", totals)
+        if len(starts) < 1:
+            return numpy.zeros(0, dtype=numpy.int64)
+        verts = numpy.empty(len(mesh.loops), dtype=numpy.int64)
+        mesh.loops.foreach_get("vertex_index", verts)
+        loop_poly = numpy.repeat(numpy.arange(len(starts)), totals)
+
+        # loops on the same vertex and uv are one uv vertex
+        quantized = numpy.round(loop_uvs * 65536.0).astype(numpy.int64)
+        order = numpy.lexsort((quantized[:, 1], quantized[:, 0], verts))
+        new = numpy.ones(len(order), dtype=bool)
+        new[1:] = (numpy.diff(verts[order]) != 0) | (numpy.diff(quantized[order], axis=0) != 0).any(axis=1)
+        uv_verts = numpy.empty(len(order), dtype=numpy.int64)
+        uv_verts[order] = numpy.cumsum(new) - 1
+
+        # label propagation with pointer jumping, every uv vertex ends on the smallest label of its island
+        labels = numpy.arange(uv_verts.max() + 1)
+        while True:
+            poly_labels = numpy.minimum.reduceat(labels[uv_verts], starts)
+            update = labels.copy()
+            numpy.minimum.at(update, uv_verts, poly_labels[loop_poly])
+            update = update[update]
+            if (update == labels).all():
+                break
+            labels = update
+        return numpy.unique(poly_labels, return_inverse=True)[1]
+
+    def raster_mesh(self, scene, bakepass, lowpoly):
+        # triangles of the evaluated lowpoly in uv space, with the pass values at their corners
+        mesh = lowpoly.to_mesh(scene, True, 'RENDER')
+        try:
+            triangles = self.mesh_triangles(lowpoly.name, mesh)
+            if triangles is None:
+                return None
+            loop_uvs, poly, corners = triangles
+
+            if bakepass.pass_name == "UV":
+                # the pass holds the render uv map, the target is laid out on the bake uv map
+                values = loop_uvs
+                for index, uvtex in enumerate(mesh.uv_textures):
+                    if uvtex.active_render:
+                        values = numpy.empty(len(mesh.loops) * 2, dtype=numpy.float32)
+                        mesh.uv_layers[index].data.foreach_get("uv", values)
+                        values = values.reshape(-1, 2)
+                        break
+                values = numpy.column_stack((values, numpy.ones(len(values), dtype=numpy.float32)))[corners]
+
+            elif bakepass.pass_name == "MAT_ID":
+                colors = [(0.8, 0.8, 0.8)]
+                if len(lowpoly.material_slots) > 0:
+                    colors = [slot.material.diffuse_color[:] if slot.material is not None else (0.8, 0.8, 0.8)
+                        for slot in lowpoly.material_slots]
+                indices = numpy.empty(len(mesh.polygons), dtype=numpy.int64)
+                mesh.polygons.foreach_get("material_index", indices)
+                indices = numpy.clip(indices, 0, len(colors) - 1)
+                values = numpy.array(colors, dtype=numpy.float32)[indices[poly]]
+                values = numpy.repeat(values[:, numpy.newaxis], 3, axis=1)
+
+            else:
+                if bakepass.nm_space == 'TANGENT':
+                    # the tangent frame is built around the shading normal
+                    values = numpy.zeros((len(poly), 3, 3), dtype=numpy.float32)
+                    values[:, :, 2] = 1.0
+                else:
+                    # split normals follow smooth, flat and custom normals as the render does
+                    mesh.calc_normals_split()
+                    values = numpy.empty(len(mesh.loops) * 3, dtype=numpy.float32)
+                    mesh.loops.foreach_get("normal", values)
+                    values = values.reshape(-1, 3)[corners]
+
+            return loop_uvs[corners], values
+        finally:
+            bpy.data.meshes.remove(mesh)
+
+    def denoise_guides(self, job, width, height, origin=None, extent=None):
+        # uv island ids and object space normals of the lowpolys at target resolution,
+        # origin and extent in output pixels place a tile, computed once per job and tile
+        key = (job.as_pointer(), width, height, None if origin is None else tuple(origin))
+        if key in self.guides:
+            return self.guides[key]
+
+        size = numpy.array([job.resolutionX, job.resolutionY], dtype=numpy.float32)
+        if origin is None:
+            origin = numpy.zeros(2, dtype=numpy.float32)
+            extent = size
+        islands = MeltdownRaster(width, height, blend=False)
+        normals = MeltdownRaster(width, height)
+        count = 0
+        for pair in job.pairs:
+            if not pair.activated:
+                continue
+            lowpoly = self.src_scene.objects.get(pair.lowpoly)
+            if lowpoly is None or lowpoly.type != 'MESH':
+                continue
+            mesh = lowpoly.to_mesh(self.src_scene, True, 'RENDER')
+            try:
+                triangles = self.mesh_triangles(pair.lowpoly, mesh)
+                if triangles is None or len(triangles[1]) < 1:
+                    continue
+                loop_uvs, poly, corners = triangles
+                uvs = (loop_uvs[corners] * size - origin) / extent
+
+                # 0 is left for texels outside the lowpolys
+                ids = self.uv_islands(mesh, loop_uvs) + count + 1
+                count = int(ids.max())
+                values = numpy.zeros((len(poly), 3, 3), dtype=numpy.float32)
+                values[:, :, 0] = ids[poly][:, numpy.newaxis]
+                islands.add(uvs, values)
+
+                mesh.calc_normals_split()
+                loop_normals = numpy.empty(len(mesh.loops) * 3, dtype=numpy.float32)
+                mesh.loops.foreach_get("normal", loop_normals)
+                normals.add(uvs, loop_normals.reshape(-1, 3)[corners])
+            finally:
+                bpy.data.meshes.remove(mesh)
+
+        normals = normals.pixels()[:, :, :3]
+        normals /= numpy.maximum(numpy.sqrt((normals * normals).sum(axis=2)), 1e-8)[:, :, numpy.newaxis]
+        islands = numpy.rint(islands.pixels()[:, :, 0]).astype(numpy.int32)
+        self.guides[key] = (islands, normals)
+        return self.guides[key]
+
+    def denoise_pixels(self, job, bakepass, pixels, origin=None, extent=None):
+        # data passes hold no noise to remove
+        if bakepass.denoise <= 0.0 or bakepass.is_data_pass():
+            return pixels
+        with meltdown_profiler.phase("denoise"):
+            height, width = pixels.shape[:2]
+            islands, normals = self.denoise_guides(job, width, height, origin, extent)
+            return denoise(pixels, islands, normals, bakepass.denoise)
+
+    def raster_pass(self, context, progress, src_scene, job, bakepass):
+        # scan convert the lowpolys at output resolution, the anti-aliasing factor sets the samples per pixel
+        print("raster_pass")
+        pairs = [pair for pair in job.pairs if pair.activated]
+        raster = MeltdownRaster(job.resolutionX, job.resolutionY, samples=job.get_aa_factor())
+
+        progress.enter_substeps(len(pairs))
+        for pair in pairs:
+            progress.step()
+            meltdown_osd.update(progress, obj=("Object: %s" % (pair.lowpoly)), passe=("Pass: %s" % (bakepass.pass_name)))
+
+            if context.area is not None:
+                context.area.tag_redraw()
+
+            meltdown_profiler.tag(pair=pair.lowpoly)
+            with meltdown_profiler.phase("rasterize"):
+                triangles = self.raster_mesh(src_scene, bakepass, src_scene.objects[pair.lowpoly])
+                if triangles is not None:
+                    raster.add(*triangles)
+            yield
+
+        meltdown_profiler.tag(pair="")
+
+        with meltdown_profiler.phase("postprocess_numpy"):
+            pixels = raster.pixels()
+            covered = pixels[:, :, 3] > 0.0
+            if bakepass.pass_name == "NORMAL":
+                # swizzle as the bake does, then map -1 1 to 0 1
+                normals = pixels[covered, :3]
+                length = numpy.sqrt((normals * normals).sum(axis=1))[:, numpy.newaxis]
+                normals = normals / numpy.maximum(length, 1e-8)
+                for channel, axis in enumerate([bakepass.normal_r, bakepass.normal_g, bakepass.normal_b]):
+                    sign = -1.0 if axis.startswith("NEG") else 1.0
+                    pixels[covered, channel] = sign * normals[:, "XYZ".index(axis[-1])] * 0.5 + 0.5
+            elif bakepass.pass_name == "MAT_ID" and job.output_format != 'OPEN_EXR':
+                # material colors are linear, byte images store them srgb encoded
+                pixels = linear_to_srgb(pixels)
+
+            pixels = dilate_margin(pixels, job.margin)
+            pixels = downsample(pixels, 1, job.get_filter_width())
+            self.save_pixels(job, bakepass, pixels)
+
+        progress.leave_substeps()
+
+    def derive_recipe(self, scene, bakepass, bakepasses):
+        # how to compute a cycles composite pass from single component passes of the job,
+        # nested lists of passes, None when the pass has to be baked
+        if bakepass.engine != 'CYCLES':
+            return None
+        lights = {"DIRECT", "INDIRECT"}
+        components = {}
+        for other in bakepasses:
+            if other.engine != 'CYCLES':
+                continue
+            pass_filter = other.get_pass_filter()
+            if (len(pass_filter) == 1 and pass_filter <= {"DIRECT", "INDIRECT", "COLOR"}) or other.pass_name == "EMIT":
+                components.setdefault((other.pass_name, frozenset(pass_filter)), other)
+
+        def resolve(pass_name, pass_filter):
+            if (pass_name, pass_filter) in components:
+                return components[(pass_name, pass_filter)]
+            light = pass_filter & lights
+            if "COLOR" in pass_filter and len(light) > 0:
+                parts = [resolve(pass_name, frozenset(light)), resolve(pass_name, frozenset({"COLOR"}))]
+            elif len(light) == 2 and "COLOR" not in pass_filter:
+                parts = [resolve(pass_name, frozenset({"DIRECT"})), resolve(pass_name, frozenset({"INDIRECT"}))]
+            else:
+                return None
+            if None in parts:
+                return None
+            return parts
+
+        pass_filter = bakepass.get_pass_filter()
+        if bakepass.pass_name in ["DIFFUSE", "GLOSSY", "TRANSMISSION", "SUBSURFACE"]:
+            if len(pass_filter) < 2:
+                return None
+            return resolve(bakepass.pass_name, frozenset(pass_filter))
+
+        if bakepass.pass_name == "COMBINED":
+            # world ambient occlusion has no component pass to add
+            if "AO" in pass_filter and scene.world is not None and scene.world.light_settings.use_ambient_occlusion:
+                return None
+            light = pass_filter & lights
+            if len(light) < 1:
+                return None
+            parts = []
+            for pass_name in ["DIFFUSE", "GLOSSY", "TRANSMISSION", "SUBSURFACE"]:
+                if pass_name in pass_filter:
+                    parts.append(resolve(pass_name, frozenset(light | {"COLOR"})))
+            if "EMIT" in pass_filter:
+                parts.append(components.get(("EMIT", frozenset({"NONE"}))))
+            if len(parts) < 1 or None in parts:
+                return None
+            return parts
+
+        return None
+
+    def recipe_passes(self, recipe):
+        if not isinstance(recipe, list):
+            return [recipe]
+        passes = []
+        for part in recipe:
+            passes.extend(self.recipe_passes(part))
+        return passes
+
+    def has_buffers(self, recipe):
+        return all(part.as_pointer() in self.buffers for part in self.recipe_passes(recipe))
+
+    def derive_pixels(self, recipe):
+        # (blend mode, linear pixels), ADD parts are summed then multiplied by MULTIPLY parts
+        if not isinstance(recipe, list):
+            return recipe.get_blend_mode(), self.buffers[recipe.as_pointer()]
+        adds = []
+        multiplies = []
+        for part in recipe:
+            mode, pixels = self.derive_pixels(part)
+            if mode == 'MULTIPLY':
+                multiplies.append(pixels)
+            else:
+                adds.append(pixels)
+        parts = adds + multiplies
+        # coverage is the same for every component, keep the alpha of the first one
+        result = numpy.array(parts[0], dtype=numpy.float32)
+        if len(adds) > 0:
+            for pixels in adds[1:]:
+                result[..., :3] += pixels[..., :3]
+            for pixels in multiplies:
+                result[..., :3] *= pixels[..., :3]
+            return 'ADD', result
+        for pixels in multiplies[1:]:
+            result[..., :3] *= pixels[..., :3]
+        return 'MULTIPLY', result
+
+    def derive_pass(self, job, bakepass, recipe):
+        print("derive_pass")
+        mode, pixels = self.derive_pixels(recipe)
+        self.save_pixels(job, bakepass, pixels, linear=True)
+        yield
+
+    def record_pass(self, job, bakepass, bake, *args):
+        # time one pass bake and collect its result for the summary
+        filepath = bpy.path.abspath(bakepass.get_filepath(job))
+        entry = {'job': job.make_filename(bpy.context), 'pass': bakepass.get_pass_fullname(),
+            'file': filepath, 'time': 0.0, 'skipped': False, 'error': "", 'samples': bakepass.samples}
+        start = time.time()
+        meltdown_profiler.tag(**{'pass': entry['pass']})
+        try:
+            with meltdown_profiler.phase("pass"):
+                yield from bake(*args)
+        except Exception:
+            # GeneratorExit from a cancel is not caught here
+            if not self.headless:
+                raise
+            entry['error'] = traceback.format_exc()
+            print(entry['error'])
+            self.summary['failures'].append(entry)
+        entry['time'] = time.time() - start
+        entry['samples'] = self.samples_used.get(filepath, entry['samples'])
+
+        # a file still in the post process worker is booked once written
+        if self.post_worker is not None and filepath in self.post_worker.pending:
+            self.post_worker.pending[filepath]['done'].append(lambda error: self.finish_pass(entry, filepath, error))
+        else:
+            self.finish_pass(entry, filepath, "")
+        self.post_poll()
+
+    def finish_pass(self, entry, filepath, error):
+        if error:
+            entry['error'] = error
+            print(error)
+            self.summary['failures'].append(entry)
+        self.summary['passes'].append(entry)
+        # a failed worker save stops an interactive bake, as a failed save on the main thread does,
+        # while cleaning up after a cancel or an error it is only reported
+        if error and not self.headless:
+            if not self.post_cleanup:
+                raise RuntimeError("Saving %s failed\n%s" % (filepath, error))
+            self.report({'ERROR'}, "Saving %s failed" % filepath)
+        if not entry['error'] and os.path.exists(filepath):
+            self.summary['files'].append(filepath)
+            if self.checkpoint is not None:
+                self.checkpoint.add(filepath)
+            if filepath in self.signatures:
+                self.dedupe_files[self.signatures[filepath]] = filepath
+            # remember inputs of the file written by this run, a cancel keeps finished passes
+            if filepath in self.keys:
+                key, mtime = self.keys[filepath]
+                if mtime != os.path.getmtime(filepath):
+                    self.cache.store(filepath, key)
+
+    def skip_pass(self, job, bakepass, filepath):
+        self.summary['passes'].append({'job': job.make_filename(bpy.context), 'pass': bakepass.get_pass_fullname(),
+            'file': filepath, 'time': 0.0, 'skipped': True, 'error': "", 'samples': 0})
+        # an up to date file is as good a dedupe source as a fresh one
+        if filepath in self.signatures:
+            self.dedupe_files.setdefault(self.signatures[filepath], filepath)
+
+    def fail(self, message):
+        self.report({'INFO'}, message)
+        self.summary['failures'].append({'job': "", 'pass': "", 'file': "", 'time': 0.0, 'skipped': False, 'error': message})
+        return {'CANCELLED'}
+
+    def bake_passes(self, context, progress, src_scene, job, bakepasses):
+        # full copy needs a screen to switch scenes
+        if src_scene.meltdown_settings.scene_builder == 'MINIMAL' or context.screen is None:
+            yield from self.bake_job(context, progress, src_scene, job, bakepasses)
+        else:
+            if int(job.tiles) > 1:
+                self.report({'WARNING'}, "%s: tiles need the minimal bake scene, baking the whole image" % job.make_filename(context))
+            for bakepass in bakepasses:
+                yield from self.record_pass(job, bakepass, self.bake_pass, context, progress, src_scene, job, bakepass)
 
-            self.prepare_multires(tmp_scene, job, bakepass, pair)
-            self.prepare_scene(tmp_scene, job, bakepass, pair, highPolyGroup)
-            self.bake_set(tmp_scene, job, bakepass, pair)
-            # update context (attempt to prevent ACCESS_VIOLATION on scenes.remove() 2.78a windows 10)
-            bpy.context.screen.scene = src_scene
-            self.cleanup(tmp_scene)
+    def bake_job(self, context, progress, src_scene, job, bakepasses):
+        print("bake_job")
+        pairs = [pair for pair in job.pairs if pair.activated]
+        if len(pairs) < 1 or len(bakepasses) < 1:
+            return
 
-        # out of pairs loop to support Atlas mode
-        self.cleanup_render_target(job, bakepass)
+        # Tag baked objects, copies in the bake scene inherit the tag
+        for pair in pairs:
+            src_scene.objects[pair.lowpoly]["bake_object"] = True
 
-        progress.leave_substeps()
+        # Switch engine and material sources
+        bpy.ops.meltdown.switch_materials(engine=bakepasses[0].engine, link='DATA',all_objects=False)
+
+        with meltdown_profiler.phase("scene_build"):
+            session = self.scene_build(src_scene, job, bakepasses, pairs)
+        try:
+            for bakepass in bakepasses:
+                yield from self.record_pass(job, bakepass, self.bake_session_pass, context, progress, session, job, bakepass)
+        finally:
+            # update context (attempt to prevent ACCESS_VIOLATION on scenes.remove() 2.78a windows 10)
+            self.set_context_scene(src_scene)
+            meltdown_profiler.tag(**{'pass': "", 'pair': ""})
+            with meltdown_profiler.phase("cleanup"):
+                self.cleanup(session.scene)
 
     def remove_object(self, object):
         if bpy.data.objects.find(object.name) > -1:
@@ -841,39 +2979,8 @@ class MeltdownBakeOp(Operator):
 
     def cleanup(self, scene):
         print("cleanup")
-        # realy clean up everything, still left to check for particles
-        attrs = ["materials", "textures", "images", "groups"]
-
-        print("cleanup remove_objects")
-        for object in scene.objects:
-            self.remove_object(object)
-
-        print("cleanup remove_scene")
-        bpy.data.scenes.remove(scene, do_unlink=True)
-
-        for object in bpy.data.objects:
-            if hasattr(object, "md_orig_name"):
-                del object["md_orig_name"]
-
-        print("cleanup remove_blocks")
-        for attr in attrs:
-            blocks = getattr(bpy.data, attr)
-            for block in blocks:
-                if block.name.endswith("MD_TMP"):
-                    blocks.remove(block, do_unlink=True)
-                else:
-                    if hasattr(object, "md_orig_name"):
-                        del block["md_orig_name"]
-
-        print("cleanup remove_linestyles and curves")
-        for attr in ["linestyles", "curves"]:
-            blocks = getattr(bpy.data, attr)
-            for block in blocks:
-                if not block.users:
-                    blocks.remove(block, do_unlink=True)
-
-        print("cleanup remove_world")
-        bpy.data.worlds.remove(bpy.data.worlds["MD_TMP"], do_unlink=True)
+        # remove exactly the datablocks created for this bake, scene included
+        self.registry.cleanup()
 
     def compo_nodes_margin_without_sharpness(self, job, bakepass, targetimage):
 
@@ -944,123 +3051,96 @@ class MeltdownBakeOp(Operator):
     def compo_nodes_margin(self, job, bakepass, targetimage):
         print("compo_nodes_margin")
 
-        bpy.ops.scene.new(type = "EMPTY")
-        bpy.context.scene.name = "MD_COMPO"
-
-        scene = bpy.context.scene
-
-        # make sure the compositor is using nodes
-        scene.use_nodes = True
-        # make sure the scene use compositor
-        scene.render.use_compositing = True
-        scene.render.resolution_x = job.resolutionX
-        scene.render.resolution_y = job.resolutionY
-        scene.render.resolution_percentage = 100
-        scene.render.image_settings.compression = 0
-        scene.render.image_settings.file_format = job.output_format
-        scene.render.filepath = bakepass.get_filepath(job)
-
         filename = bakepass.get_filename(job)
 
         if bpy.data.images.find(filename) > -1:
             bpy.data.images.remove(bpy.data.images[filename] ,do_unlink = True)
 
-        tree = scene.node_tree
-
-        # get rid of all nodes
-        for node in tree.nodes:
-            tree.nodes.remove(node)
-
-        # make a dictionary of all the nodes we're going to need
-        # the vector is for placement only, otherwise useless
-        nodes = {
-            "Image": ["CompositorNodeImage", (-900.0, 100.0)],
-            "Inpaint": ["CompositorNodeInpaint", (-700.0, 100.0)],
-            "Filter": ["CompositorNodeValue", (-700.0, -100.0)],
-            "Negative": ["CompositorNodeMath", (-700.0, -300.0)],
-            "TF1": ["CompositorNodeTransform", (-500.0, 100.0)],
-            "TF2": ["CompositorNodeTransform", (-500.0, -100.0)],
-            "TF3": ["CompositorNodeTransform", (-500.0, -300.0)],
-            "TF4": ["CompositorNodeTransform", (-500.0, -500.0)],
-            "Mix1": ["CompositorNodeMixRGB", (-300.0, 100.0)],
-            "Mix2": ["CompositorNodeMixRGB", (-300.0, -300.0)],
-            "Mix3": ["CompositorNodeMixRGB", (-100.0, 100.0)],
-            "Output": ["CompositorNodeComposite", (200.0, 100.0)]
-        }
-
-        # add all the listed nodes
-        for key, node_data in nodes.items():
-            node = tree.nodes.new(type = node_data[0])
-            node.location = node_data[1]
-            node.name = key
-            node.label = key
-
-        links = [
-            ["Image", "Image", "Inpaint", "Image"],
-            ["Filter", "Value", "Negative", 1],
-            ["Inpaint", "Image", "TF1", "Image"],
-            ["Inpaint", "Image", "TF2", "Image"],
-            ["Inpaint", "Image", "TF3", "Image"],
-            ["Inpaint", "Image", "TF4", "Image"],
-            ["Filter", "Value", "TF1", 2],
-            ["Filter", "Value", "TF2", 1],
-            ["Filter", "Value", "TF2", 2],
-            ["Filter", "Value", "TF4", 1],
-            ["Negative", "Value", "TF1", 1],
-            ["Negative", "Value", "TF3", 1],
-            ["Negative", "Value", "TF3", 2],
-            ["Negative", "Value", "TF4", 2],
-            ["TF1", "Image", "Mix1", 1],
-            ["TF2", "Image", "Mix1", 2],
-            ["TF3", "Image", "Mix2", 1],
-            ["TF4", "Image", "Mix2", 2],
-            ["Mix1", "Image", "Mix3", 1],
-            ["Mix2", "Image", "Mix3", 2],
-            ["Mix3", "Image", "Output", "Image"]
-        ]
+        self.compositor.render(job, bakepass.get_filepath(job), targetimage)
+
+    def postprocess_numpy(self, job, bakepass, targetimage):
+        print("postprocess_numpy")
+
+        factor = job.get_aa_factor()
+        pixels = read_pixels(targetimage)
+        pixels = self.denoise_pixels(job, bakepass, pixels)
+
+        # components of derived passes are needed on this thread
+        if self.post_worker is not None and bakepass.as_pointer() not in self.components:
+            filename = bakepass.get_filename(job)
+            if bpy.data.images.find(filename) > -1:
+                bpy.data.images.remove(bpy.data.images[filename] ,do_unlink = True)
+            # float targets are encoded after margin and downsample, as save_pixels does
+            self.post_worker.put(bpy.path.abspath(bakepass.get_filepath(job)), pixels, job.output_format,
+                lambda pixels: self.write_image(job, bakepass, pixels),
+                margin=job.margin * factor, factor=factor, filter_width=job.get_filter_width(),
+                linear=self.use_float_target(job, bakepass) and job.output_format != 'OPEN_EXR')
+            return
 
-        for link in links:
-            output = tree.nodes[link[0]].outputs[link[1]]
-            input = tree.nodes[link[2]].inputs[link[3]]
-            tree.links.new(output, input)
+        pixels = dilate_margin(pixels, job.margin * factor)
+        pixels = downsample(pixels, factor, job.get_filter_width())
+        self.save_pixels(job, bakepass, pixels, linear=self.use_float_target(job, bakepass))
 
-        if job.antialiasing == '0':
-            margin = job.margin
-            filter_width = 0.0
-            print("filter "+str(filter_width))
-            transform_scale = 1
+    def save_pixels(self, job, bakepass, pixels, linear=False):
+        filename = bakepass.get_filename(job)
 
-        if job.antialiasing == '2':
-            margin = job.margin*2
-            filter_width = (1.0-job.aa_sharpness)/2.0
-            print("filter "+str(filter_width))
-            transform_scale = 0.5
+        if bpy.data.images.find(filename) > -1:
+            bpy.data.images.remove(bpy.data.images[filename] ,do_unlink = True)
 
-        if job.antialiasing == '4':
-            margin = job.margin*4
-            filter_width = (1.0-job.aa_sharpness)/2.0
-            print("filter "+str(filter_width))
-            transform_scale = 0.25
+        # keep components of derived passes, in linear space
+        if bakepass.as_pointer() in self.components:
+            self.buffers[bakepass.as_pointer()] = pixels
+        # float targets hold linear light, byte files are display encoded
+        if linear and job.output_format != 'OPEN_EXR':
+            pixels = linear_to_srgb(pixels)
 
-        tree.nodes["Image"].image = targetimage
-        tree.nodes["Inpaint"].distance = margin
-        tree.nodes["Filter"].outputs[0].default_value = filter_width
-        tree.nodes["Negative"].inputs[0].default_value = 0.0
-        tree.nodes["Negative"].operation = "SUBTRACT"
-        tree.nodes["TF1"].inputs[4].default_value = transform_scale
-        tree.nodes["TF2"].inputs[4].default_value = transform_scale
-        tree.nodes["TF3"].inputs[4].default_value = transform_scale
-        tree.nodes["TF4"].inputs[4].default_value = transform_scale
-        tree.nodes["TF1"].filter_type = "BICUBIC"
-        tree.nodes["TF2"].filter_type = "BICUBIC"
-        tree.nodes["TF3"].filter_type = "BICUBIC"
-        tree.nodes["TF4"].filter_type = "BICUBIC"
-        tree.nodes["Mix1"].inputs[0].default_value = 0.5
-        tree.nodes["Mix2"].inputs[0].default_value = 0.5
-        tree.nodes["Mix3"].inputs[0].default_value = 0.5
+        if self.post_worker is not None and job.output_format in image_writers:
+            self.post_worker.put(bpy.path.abspath(bakepass.get_filepath(job)), pixels, job.output_format, None)
+            return
 
-        bpy.ops.render.render(write_still = True, scene = "MD_COMPO")
-        bpy.ops.scene.delete()
+        self.write_image(job, bakepass, pixels)
+
+    def write_image(self, job, bakepass, pixels):
+        height, width = pixels.shape[:2]
+        image = meltdown_target_pool.acquire(width, height, use_float=job.output_format == 'OPEN_EXR')
+        write_pixels(image, pixels)
+        self.compositor.save(job, bakepass.get_filepath(job), image)
+        meltdown_target_pool.release(image)
+
+    def post_poll(self, wait=False):
+        # book passes whose file the worker wrote, save the ones it handed back
+        worker = self.post_worker
+        while worker is not None and len(worker.pending) > 0:
+            try:
+                filepath, pixels, error = worker.results.get(block=wait, timeout=worker.timeout if wait else None)
+            except queue.Empty:
+                if not wait:
+                    return
+                worker.give_up()
+                continue
+            pending = worker.pending.pop(filepath, None)
+            if pending is None:
+                # a late result of a pass already given up
+                continue
+            if not error and pixels is not None:
+                try:
+                    pending['save'](pixels)
+                except Exception:
+                    error = traceback.format_exc()
+            for done in pending['done']:
+                done(error)
+
+    def post_join(self, cleanup=False):
+        # every queued pass is on disk and booked
+        if self.post_worker is None:
+            return
+        self.post_cleanup = cleanup
+        try:
+            with meltdown_profiler.phase("post_join"):
+                self.post_poll(wait=True)
+        finally:
+            self.post_worker.stop()
+            self.post_worker = None
 
     def scan_empty_mat(self, scene, jobs):
         res = False
@@ -1083,55 +3163,641 @@ class MeltdownBakeOp(Operator):
                             res = True
         return res
 
-    def execute(self, context):
+    def prepare(self, context):
+        # checks and per run state, returns a set when the bake can not start
+        global meltdown_last_summary
+        global meltdown_running_bake
+
+        # a second bake would share the target pool and the MD_TMP names
+        if meltdown_running_bake is not None:
+            self.report({'WARNING'}, "A bake is already running")
+            return {'CANCELLED'}
 
-        wm = context.window_manager
         src_scene = context.scene
+        # source of the lowpoly meshes while bake scenes are current
+        self.src_scene = src_scene
 
-        jobs = [job for job in src_scene.meltdown_settings.jobs if job.activated]
-        if len(jobs) < 1:
-            self.report({'INFO'}, "No job found in queue, use Add job.")
-            return {'CANCELLED'}
+        self.summary = {'files': [], 'passes': [], 'failures': [], 'time': 0.0}
+        meltdown_last_summary = self.summary
 
-        if self.scan_empty_mat(src_scene, jobs):
-            return {'CANCELLED'}
+        self.jobs = [job for job in src_scene.meltdown_settings.jobs if job.activated]
+        if len(self.jobs) < 1:
+            return self.fail("No job found in queue, use Add job.")
+
+        if self.scan_empty_mat(src_scene, self.jobs):
+            return self.fail("Highpoly objects without material")
 
         # ensure save path exists
-        for job in jobs:
+        for job in self.jobs:
             if not os.path.exists(bpy.path.abspath(job.output)):
                 try:
                     os.makedirs(bpy.path.abspath(job.output))
                 except Exception as e:
-                    self.report({'INFO'}, "Directory "+job.output+" is not writable.")
-                    return {'CANCELLED'}
+                    return self.fail("Directory "+job.output+" is not writable.")
+
+        self.settings = src_scene.meltdown_settings
+        self.registry = MeltdownTempRegistry()
+        self.compositor = MeltdownCompositor()
+        self.cache = MeltdownBakeCache()
+        self.keys = {}
+        # object hashes of pass keys, computed once per run
+        self.job_keys = {}
+        self.object_keys = {}
+        # dupli group name -> [(object, matrix)]
+        self.duplis = {}
+        # output file -> job signature, job signature -> baked file
+        self.signatures = {}
+        self.dedupe_files = {}
+        # output file -> samples used by adaptive passes
+        self.samples_used = {}
+        # denoise guides of the current job
+        self.guides = {}
+        self.post_worker = None
+        self.post_cleanup = False
+        if self.settings.pipeline and self.settings.postprocess == 'NUMPY':
+            self.post_worker = MeltdownPostWorker(self.settings.pipeline_queue)
+        # pointers of passes derived passes are computed from, their pixels
+        self.components = set()
+        self.buffers = {}
+        # farm workers share the .blend, the farm keeps track of its units itself
+        self.checkpoint = None
+        if self.finish:
+            self.checkpoint = MeltdownCheckpoint()
+            if self.settings.resume:
+                self.checkpoint.load()
+            else:
+                self.checkpoint.save()
+        meltdown_profiler.reset()
+        meltdown_profiler.enabled = self.settings.use_profiler
+        meltdown_profiler.use_memory = self.settings.profile_memory
+        meltdown_target_pool.limit = src_scene.meltdown_settings.target_pool_limit * 1024 * 1024
+        # file and uv map names resolve against the source scene, whatever the context scene
+        meltdown_atlas_index.pin(src_scene)
+        meltdown_running_bake = self
+        return None
+
+    def bake_steps(self, context):
+        # the whole bake, yields after every pair so a modal operator can interleave events
+        wm = context.window_manager
+        src_scene = context.scene
+        start = time.time()
+
+        if not self.headless:
+            meltdown_osd.rate = self.settings.osd_rate
+            meltdown_osd.start()
+
+        try:
+            with ProgressReport(wm) as progress:  # Not giving a WindowManager here will default to console printing.
+                progress.enter_substeps(len(self.jobs))
+
+                if self.finish:
+                    bpy.ops.meltdown.remove_baked_material()
+
+                for job in self.jobs:
+
+                    bakepasses = [bakepass for bakepass in job.bakepasses if bakepass.activated]
+                    meltdown_profiler.tag(**{'job': job.make_filename(bpy.context), 'pass': "", 'pair': ""})
+
+                    for bakepass in bakepasses[:]:
+                        filepath = bpy.path.abspath(bakepass.get_filepath(job))
+
+                        signature = None
+                        if self.settings.dedupe:
+                            signature = self.job_signature(job, bakepass)
+                            if signature is not None:
+                                self.signatures[filepath] = signature
+
+                        # skip passes finished before a crash
+                        if self.checkpoint is not None and self.settings.resume and self.checkpoint.is_done(filepath):
+                            print("skip finished %s" % filepath)
+                            bakepasses.remove(bakepass)
+                            self.skip_pass(job, bakepass, filepath)
+                            continue
+
+                        # copy the output of an identical job baked before
+                        if signature is not None:
+                            src = self.dedupe_files.get(signature)
+                            if src is not None and src != filepath and os.path.exists(src):
+                                bakepasses.remove(bakepass)
+                                self.copy_pass(src_scene, job, bakepass, src, filepath)
+                                continue
+
+                        # skip passes whose inputs did not change since their file was written
+                        if self.settings.use_cache:
+                            with meltdown_profiler.phase("pass_key"):
+                                key = self.pass_key(src_scene, job, bakepass)
+                            if not self.settings.force_rebake and self.cache.is_valid(filepath, key):
+                                print("skip unchanged %s" % filepath)
+                                bakepasses.remove(bakepass)
+                                self.skip_pass(job, bakepass, filepath)
+                                continue
+                            mtime = None
+                            if os.path.exists(filepath):
+                                mtime = os.path.getmtime(filepath)
+                            self.keys[filepath] = (key, mtime)
+
+                    # composites of component passes baked in this run are computed, not traced
+                    derived = []
+                    if self.settings.derive_passes and self.settings.postprocess == 'NUMPY':
+                        for bakepass in bakepasses:
+                            recipe = self.derive_recipe(src_scene, bakepass, bakepasses)
+                            if recipe is not None:
+                                derived.append((bakepass, recipe))
+                                for component in self.recipe_passes(recipe):
+                                    self.components.add(component.as_pointer())
+                        for bakepass, recipe in derived:
+                            bakepasses.remove(bakepass)
+
+                    # passes without anything to trace are rasterized from the lowpoly meshes
+                    rasterized = [bakepass for bakepass in bakepasses if self.can_rasterize(src_scene, job, bakepass)]
+                    for bakepass in rasterized:
+                        bakepasses.remove(bakepass)
+
+                    progress.enter_substeps(len(rasterized) + len(bakepasses) + len(derived))
+
+                    for bakepass in rasterized:
+                        yield from self.record_pass(job, bakepass, self.raster_pass, context, progress, src_scene, job, bakepass)
+
+                    yield from self.bake_passes(context, progress, src_scene, job, bakepasses)
+
+                    # composites missing a component, failed or cancelled, are baked after all
+                    fallback = [bakepass for bakepass, recipe in derived if not self.has_buffers(recipe)]
+                    derived = [(bakepass, recipe) for bakepass, recipe in derived if self.has_buffers(recipe)]
+                    if len(fallback) > 0:
+                        yield from self.bake_passes(context, progress, src_scene, job, fallback)
+
+                    for bakepass, recipe in derived:
+                        meltdown_profiler.tag(pair="")
+                        yield from self.record_pass(job, bakepass, self.derive_pass, job, bakepass, recipe)
+                    self.components = set()
+                    self.buffers = {}
+                    self.guides = {}
+
+                    progress.leave_substeps()
+
+
+                meltdown_profiler.tag(**{'job': "", 'pass': "", 'pair': ""})
+                # baked maps are loaded from their files
+                self.post_join()
+                if self.finish:
+                    # Create material with baked maps
+                    bpy.ops.meltdown.create_baked_material()
+
+                    # Show up result
+                    bpy.ops.meltdown.switch_materials(engine='BLENDER_RENDER', link='OBJECT',all_objects=False)
+                progress.leave_substeps("Finished !")
+
+            # the queue went through, nothing to resume
+            if self.checkpoint is not None and len(self.summary['failures']) < 1:
+                self.checkpoint.remove()
+        finally:
+            # runs on cancel too, temporary data is gone and finished files are kept
+            self.post_join(cleanup=True)
+            self.cache.save()
+            self.compositor.free()
+            meltdown_target_pool.clear()
+
+            if not self.headless:
+                meltdown_osd.end()
+
+            self.summary['time'] = time.time() - start
+            meltdown_profiler.finish()
+            self.release()
+
+    def execute(self, context):
+        res = self.prepare(context)
+        if res is not None:
+            return res
+
+        for step in self.bake_steps(context):
+            pass
+
+        if len(self.summary['failures']) > 0:
+            self.report({'WARNING'}, "%s passes failed" % len(self.summary['failures']))
+
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        if self.headless or not context.scene.meltdown_settings.use_modal:
+            return self.execute(context)
 
-        meltdown_osd.start()
+        res = self.prepare(context)
+        if res is not None:
+            return res
+
+        # bpy.context stays valid between modal events, the invoke context does not
+        self.steps = self.bake_steps(bpy.context)
+        self.paused = False
+        self.src_scene_name = context.scene.name
+        self.tick_scene = None
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(0.01, context.window)
+        wm.modal_handler_add(self)
+        self.report({'INFO'}, "Baking, ESC to cancel, P to pause")
+        return {'RUNNING_MODAL'}
+
+    def release(self):
+        global meltdown_running_bake
+        if meltdown_running_bake is self:
+            meltdown_running_bake = None
+            meltdown_atlas_index.unpin()
+
+    def end_modal(self, context):
+        if self.timer is not None:
+            context.window_manager.event_timer_remove(self.timer)
+        self.timer = None
+        # cancelled before the first tick, the finally of bake_steps never ran
+        if self.post_worker is not None:
+            self.post_worker.lost = True
+            self.post_worker.stop()
+            self.post_worker = None
+        self.release()
+
+    def cancel_modal(self, context, message):
+        # closing the generator runs every finally on the way out: MD_TMP cleanup, cache save
+        self.restore_tick_scene()
+        self.steps.close()
+        self.end_modal(context)
+        self.report({'WARNING'}, message)
+
+    def restore_tick_scene(self):
+        # the generator left off in its bake scene
+        if self.tick_scene is not None and bpy.data.scenes.find(self.tick_scene) > -1:
+            self.set_context_scene(bpy.data.scenes[self.tick_scene])
+        self.tick_scene = None
+
+    def show_source_scene(self):
+        # between ticks the user sees the scene the bake started from, not MD_TMP
+        if bpy.context.screen is None or bpy.data.scenes.find(self.src_scene_name) < 0:
+            return
+        self.tick_scene = bpy.context.screen.scene.name
+        self.set_context_scene(bpy.data.scenes[self.src_scene_name])
+
+    def blocks_shortcut(self, context, event):
+        if (event.ctrl or event.oskey) and not event.alt:
+            # undo, redo, new, open, quit
+            return event.type in {'Z', 'Y', 'N', 'O', 'Q'}
+        if event.type not in {'X', 'DEL'} or event.ctrl or event.alt or event.oskey:
+            return False
+        # deletes only happen in the main region of the data editors
+        area, region = context.area, context.region
+        return area is not None and region is not None and region.type == 'WINDOW' and \
+            area.type in {'VIEW_3D', 'OUTLINER', 'NODE_EDITOR', 'IMAGE_EDITOR'}
+
+    def modal(self, context, event):
+        # cancelled from an undo or file load handler
+        if self.timer is None:
+            return {'CANCELLED'}
+
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.cancel_modal(context, "Baking cancelled, finished passes are kept")
+            return {'CANCELLED'}
+
+        # the bake holds references to objects, scenes and images:
+        # shortcuts that undo, delete or load data wait until it is done,
+        # text fields and other keys keep working
+        if event.value == 'PRESS' and self.blocks_shortcut(context, event):
+            return {'RUNNING_MODAL'}
+
+        if event.type == 'P' and event.value == 'PRESS':
+            self.paused = not self.paused
+            if self.paused:
+                meltdown_osd.show("Paused, P to resume, ESC to cancel", "", "")
+                self.report({'INFO'}, "Baking paused")
+            else:
+                self.report({'INFO'}, "Baking resumed")
+            return {'RUNNING_MODAL'}
+
+        if event.type != 'TIMER' or event.timer != self.timer or self.paused:
+            return {'PASS_THROUGH'}
+
+        # one pair bake per tick
+        try:
+            self.restore_tick_scene()
+            next(self.steps)
+            self.show_source_scene()
+        except StopIteration:
+            self.end_modal(context)
+            if len(self.summary['failures']) > 0:
+                self.report({'WARNING'}, "%s passes failed" % len(self.summary['failures']))
+            return {'FINISHED'}
+        except:
+            self.end_modal(context)
+            raise
+
+        return {'RUNNING_MODAL'}
+
+def bake_headless(summary_path=""):
+    """Run the bake jobs of the current scene without ui and return a summary
+
+    blender -b file.blend --python-expr "import meltdown; meltdown.bake_headless('//summary.json')"
+
+    The summary holds the files written, timing of every pass and the failures,
+    it is printed as json on one line starting with MELTDOWN_SUMMARY.
+    """
+    try:
+        bpy.ops.meltdown.bake(headless=True)
+        summary = meltdown_last_summary
+    except:
+        summary = {'files': [], 'passes': [], 'time': 0.0,
+            'failures': [{'job': "", 'pass': "", 'file': "", 'time': 0.0, 'skipped': False, 'error': traceback.format_exc()}]}
+
+    print("MELTDOWN_SUMMARY " + json.dumps(summary))
+    if summary_path != "":
+        with open(bpy.path.abspath(summary_path), 'w') as f:
+            json.dump(summary, f, indent=1)
+    return summary
+
+def farm_result_path(unit_path):
+    return unit_path[:-5] + "_result.json"
+
+def farm_worker(unit_path):
+    """Bake one farm unit, runs inside a background Blender started by the farm"""
+    with open(unit_path) as f:
+        unit = json.load(f)
+
+    result = {'id': unit['id'], 'files': [], 'time': 0.0, 'error': ""}
+    start = time.time()
+    try:
+        scene = bpy.data.scenes[unit['scene']]
+        mds = scene.meltdown_settings
+        rna_from_dict(mds, unit['settings'])
+
+        # the unit job replaces the jobs saved in the file
+        mds.jobs.clear()
+        job = mds.jobs.add()
+        rna_from_dict(job, unit['job'])
+        job.activated = True
+        for i, bakepass in enumerate(job.bakepasses):
+            bakepass.activated = i in unit['passes']
+
+        override = bpy.context.copy()
+        override['scene'] = scene
+        bpy.ops.meltdown.bake(override, finish=False, headless=True)
+
+        # skipped passes count too, their file is up to date
+        result['files'] = [entry['file'] for entry in meltdown_last_summary['passes'] if not entry['error'] and os.path.exists(entry['file'])]
+        result['error'] = "\n".join([failure['error'] for failure in meltdown_last_summary['failures']])
+    except:
+        result['error'] = traceback.format_exc()
 
-        with ProgressReport(wm) as progress:  # Not giving a WindowManager here will default to console printing.
-            progress.enter_substeps(len(jobs))
+    result['time'] = time.time() - start
+    with open(farm_result_path(unit_path), 'w') as f:
+        json.dump(result, f)
 
-            bpy.ops.meltdown.remove_baked_material()
+# Global name
+meltdown_last_summary = {}
+meltdown_farm_results = []
+# bake operator running, at most one at a time
+meltdown_running_bake = None
+
+@persistent
+def cancel_bake_handler(dummy):
+    # undo and file loads free the data a modal bake holds
+    bake = meltdown_running_bake
+    if bake is None or getattr(bake, "timer", None) is None:
+        return
+    try:
+        bake.cancel_modal(bpy.context, "Baking cancelled by undo or file load, finished passes are kept")
+    except ValueError:
+        # generator already executing, the handler fired from inside the bake
+        pass
 
-            for job in jobs:
+class MeltdownBakeFarmOp(Operator):
+    '''Process baking jobs in parallel background Blender processes'''
+
+    bl_idname = "meltdown.bake_farm"
+    bl_label = "Start Farm"
+
+    def make_units(self, scene, path):
+        mds = scene.meltdown_settings
+        settings = rna_to_dict(mds)
+        del settings['jobs']
+        units = []
+        for job in mds.jobs:
+            if not job.activated or len(job.pairs) < 1:
+                continue
+            passes = [i for i, bakepass in enumerate(job.bakepasses) if bakepass.activated]
+            if len(passes) < 1:
+                continue
+            if mds.farm_split == 'PASS':
+                groups = [[i] for i in passes]
+            else:
+                groups = [passes]
+            job_values = rna_to_dict(job)
+            for group in groups:
+                unit = {
+                    'id': len(units),
+                    'scene': scene.name,
+                    'settings': settings,
+                    'job': job_values,
+                    'passes': group,
+                    'label': job.make_filename(bpy.context) + " " + ",".join([job.bakepasses[i].get_pass_fullname() for i in group])
+                    }
+                unit['path'] = os.path.join(path, "unit_%04d.json" % unit['id'])
+                with open(unit['path'], 'w') as f:
+                    json.dump(unit, f)
+                units.append(unit)
+        return units
+
+    def start_worker(self, unit, threads):
+        expr = "import importlib, addon_utils; addon_utils.enable(%r); importlib.import_module(%r).farm_worker(%r)" % (__name__, __name__, unit['path'])
+        log = open(unit['path'][:-5] + ".log", 'w')
+        process = subprocess.Popen([bpy.app.binary_path, "-b", bpy.data.filepath, "-t", str(threads), "--python-expr", expr],
+            stdout=log, stderr=subprocess.STDOUT)
+        return process, log
+
+    def read_result(self, unit, process):
+        path = farm_result_path(unit['path'])
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        # the log goes away with the farm directory, keep its end
+        error = "Worker exited with code %s" % process.returncode
+        try:
+            with open(unit['path'][:-5] + ".log") as f:
+                error += "\n" + "".join(deque(f, maxlen=20))
+        except (OSError, ValueError):
+            pass
+        return {'id': unit['id'], 'files': [], 'time': 0.0, 'error': error}
 
-                bakepasses = [bakepass for bakepass in job.bakepasses if bakepass.activated]
-                progress.enter_substeps(len(bakepasses))
+    def start(self, context):
+        # checks and work units, returns a set when the farm can not start
+        scene = context.scene
+        mds = scene.meltdown_settings
 
-                for bakepass in bakepasses:
-                    self.bake_pass(context, progress, src_scene, job, bakepass)
+        if not bpy.data.filepath:
+            self.report({'WARNING'}, "Save the file first, farm workers open the saved .blend")
+            return {'CANCELLED'}
+        if bpy.data.is_dirty:
+            self.report({'WARNING'}, "Unsaved changes, workers only see the saved file")
 
-                progress.leave_substeps()
+        jobs = [job for job in mds.jobs if job.activated]
+        if len(jobs) < 1:
+            self.report({'INFO'}, "No job found in queue, use Add job.")
+            return {'CANCELLED'}
 
+        for job in jobs:
+            if not os.path.exists(bpy.path.abspath(job.output)):
+                try:
+                    os.makedirs(bpy.path.abspath(job.output))
+                except Exception as e:
+                    self.report({'INFO'}, "Directory "+job.output+" is not writable.")
+                    return {'CANCELLED'}
 
-            # Create material with baked maps
-            bpy.ops.meltdown.create_baked_material()
+        meltdown_atlas_index.build(scene)
+        self.path = tempfile.mkdtemp(prefix="meltdown_farm_")
+        try:
+            self.units = self.make_units(scene, self.path)
+        except Exception:
+            shutil.rmtree(self.path, ignore_errors=True)
+            raise
+        self.workers = min(mds.farm_workers, len(self.units))
+        self.threads = max(1, (os.cpu_count() or 1) // max(1, self.workers))
+
+        print("farm: %s units on %s workers, %s threads each, in %s" % (len(self.units), self.workers, self.threads, self.path))
+
+        bpy.ops.meltdown.remove_baked_material()
+
+        self.results = []
+        self.start_time = time.time()
+        # local work queue, fill free slots as workers finish
+        self.pending = list(self.units)
+        self.running = []
+        context.window_manager.progress_begin(0, max(1, len(self.units)))
+        return None
+
+    def poll_workers(self, context):
+        # start and collect workers, True once every unit is done
+        while len(self.pending) > 0 and len(self.running) < self.workers:
+            unit = self.pending.pop(0)
+            process, log = self.start_worker(unit, self.threads)
+            self.running.append((unit, process, log, time.time()))
+
+        for item in self.running[:]:
+            unit, process, log, unit_start = item
+            if process.poll() is None:
+                continue
+            self.running.remove(item)
+            log.close()
+            result = self.read_result(unit, process)
+            result['label'] = unit['label']
+            result['wall_time'] = time.time() - unit_start
+            self.results.append(result)
+            context.window_manager.progress_update(len(self.results))
+            print("farm: %s done" % unit['label'])
+
+        return len(self.pending) < 1 and len(self.running) < 1
+
+    def cleanup(self, context):
+        # stops workers left by a cancel, the directory only holds units, logs and results
+        for unit, process, log, unit_start in self.running:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+            log.close()
+        self.running = []
+        context.window_manager.progress_end()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def finish(self, context):
+        global meltdown_farm_results
+
+        meltdown_farm_results = sorted(self.results, key=lambda result: result['id'])
+
+        failed = [result for result in meltdown_farm_results if result['error']]
+        print("farm: done in %.2fs" % (time.time() - self.start_time))
+        for result in meltdown_farm_results:
+            print("farm: %-40s bake %8.2fs wall %8.2fs %s" % (result['label'], result['time'], result['wall_time'], "FAILED" if result['error'] else ""))
+            if result['error']:
+                print(result['error'])
+
+        # Create material with baked maps
+        bpy.ops.meltdown.create_baked_material()
+
+        # Show up result
+        bpy.ops.meltdown.switch_materials(engine='BLENDER_RENDER', link='OBJECT',all_objects=False)
+
+        if len(failed) > 0:
+            self.report({'WARNING'}, "%s of %s farm units failed, see console" % (len(failed), len(self.units)))
+        else:
+            self.report({'INFO'}, "%s farm units baked in %.2fs" % (len(self.units), time.time() - self.start_time))
 
-            # Show up result
-            bpy.ops.meltdown.switch_materials(engine='BLENDER_RENDER', link='OBJECT',all_objects=False)
-            progress.leave_substeps("Finished !")
+        return {'FINISHED'}
 
-        meltdown_osd.end()
+    def execute(self, context):
+        res = self.start(context)
+        if res is not None:
+            return res
+        try:
+            while not self.poll_workers(context):
+                # no window to keep responsive, sleep until the oldest worker exits
+                self.running[0][1].wait()
+        finally:
+            self.cleanup(context)
+        return self.finish(context)
+
+    def invoke(self, context, event):
+        if context.window is None:
+            return self.execute(context)
+        res = self.start(context)
+        if res is not None:
+            return res
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(0.5, context.window)
+        wm.modal_handler_add(self)
+        self.report({'INFO'}, "Farm running, ESC to cancel")
+        return {'RUNNING_MODAL'}
+
+    def end_modal(self, context):
+        context.window_manager.event_timer_remove(self.timer)
+        self.cleanup(context)
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.end_modal(context)
+            self.report({'WARNING'}, "Farm cancelled, finished units are kept")
+            return {'CANCELLED'}
+        if event.type != 'TIMER' or event.timer != self.timer:
+            return {'PASS_THROUGH'}
+        try:
+            done = self.poll_workers(context)
+        except:
+            self.end_modal(context)
+            raise
+        if not done:
+            return {'RUNNING_MODAL'}
+        self.end_modal(context)
+        return self.finish(context)
+
+class MeltdownExportProfileOp(Operator):
+    '''Export timings of the last bake'''
+
+    bl_idname = "meltdown.export_profile"
+    bl_label = "Export profile"
+
+    filepath = StringProperty(subtype='FILE_PATH')
+    format = EnumProperty(name="Format", default="JSON",
+                                    items = (("JSON","JSON","Records and summary"),
+                                            ("CHROME","Chrome trace","Load in chrome://tracing")))
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = "meltdown_profile.json"
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
 
+    def execute(self, context):
+        if self.format == 'CHROME':
+            data = meltdown_profiler.to_chrome_trace()
+        else:
+            data = meltdown_profiler.to_json()
+        try:
+            with open(bpy.path.abspath(self.filepath), 'w') as f:
+                json.dump(data, f, indent=1)
+        except Exception as e:
+            self.report({'WARNING'}, "Unable to write "+self.filepath)
+            return {'CANCELLED'}
         return {'FINISHED'}
 
 class MeltdownAddPairOp(Operator):
@@ -1207,7 +3873,130 @@ class MeltdownUnwrap(Operator):
 
     bl_idname = "meltdown.unwrap"
     bl_label = "Auto Unwrap"
+
+    # unwrap every selected mesh at once instead of the active object
+    batch = BoolProperty(default=False, options={'SKIP_SAVE'})
+
+    def add_uv_layer(self, scene, ob):
+        # use textureAtlas uv if any, False when the object is allready unwrapped
+        uvtex_name = meltdown_atlas_index.get_uvtex_name(ob.name)
+
+        for uvtex in ob.data.uv_textures:
+            if uvtex.name == uvtex_name:
+                uvtex.active = True
+                return False
+
+        uvtex = ob.data.uv_textures.new('Auto-Unwrap')
+        if uvtex is None:
+            # meshes hold 8 uv layers at most
+            self.report({'WARNING'}, "Object: "+ob.name+" has no free uv layer, skipping.")
+            return False
+        uvtex.active = True
+        return True
+
+    def unwrap_objects(self, scene, setup, objs):
+        # standalone objects, each in its own uv space, from object mode without edit mode round trips
+        if setup.auto_unwrap == 'SMART':
+            # smart project shares one uv space between the selected objects, one call per object
+            p = setup.smart_unwrap
+            for ob in objs:
+                for other in scene.objects:
+                    other.select = other == ob
+                scene.objects.active = ob
+                bpy.ops.uv.smart_project(angle_limit=p.angle_limit, island_margin=p.island_margin, user_area_weight=p.user_area_weight, \
+                                         use_aspect=p.use_aspect, stretch_to_bounds=p.stretch_to_bounds)
+        if setup.auto_unwrap == 'LIGHTMAP':
+            # lightmap pack handles every selected object in one call, packed one by one
+            for ob in scene.objects:
+                ob.select = ob in objs
+            scene.objects.active = objs[0]
+            p = setup.lightmap_unwrap
+            bpy.ops.uv.lightmap_pack(PREF_CONTEXT='ALL_OBJECTS', PREF_PACK_IN_ONE=False, PREF_NEW_UVLAYER=p.PREF_NEW_UVLAYER, \
+                                     PREF_APPLY_IMAGE=p.PREF_APPLY_IMAGE, PREF_IMG_PX_SIZE=p.PREF_IMG_PX_SIZE, PREF_BOX_DIV=p.PREF_BOX_DIV, \
+                                     PREF_MARGIN_DIV=p.PREF_MARGIN_DIV)
+
+    def unwrap_atlas(self, scene, setup, objs):
+        # objects of one atlas share its uv space, in object mode one call processes them all
+        for ob in scene.objects:
+            ob.select = ob in objs
+        scene.objects.active = objs[0]
+        if setup.auto_unwrap == 'SMART':
+            p = setup.smart_unwrap
+            bpy.ops.uv.smart_project(angle_limit=p.angle_limit, island_margin=p.island_margin, user_area_weight=p.user_area_weight, \
+                                     use_aspect=p.use_aspect, stretch_to_bounds=p.stretch_to_bounds)
+        if setup.auto_unwrap == 'LIGHTMAP':
+            p = setup.lightmap_unwrap
+            # the atlas bakes into one texture, so every object is packed in one uv space
+            bpy.ops.uv.lightmap_pack(PREF_CONTEXT='ALL_OBJECTS', PREF_PACK_IN_ONE=True, PREF_NEW_UVLAYER=p.PREF_NEW_UVLAYER, \
+                                     PREF_APPLY_IMAGE=p.PREF_APPLY_IMAGE, PREF_IMG_PX_SIZE=p.PREF_IMG_PX_SIZE, PREF_BOX_DIV=p.PREF_BOX_DIV, \
+                                     PREF_MARGIN_DIV=p.PREF_MARGIN_DIV)
+
+    def execute_batch(self, context):
+        scene = context.scene
+        setup = scene.meltdown_setup
+        meltdown_atlas_index.build(scene)
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+
+        objs = [ob for ob in context.selected_objects if ob.type == 'MESH']
+        active = scene.objects.active
+
+        # uv layers through the data api, objects sharing a mesh are unwrapped once
+        todo = []
+        meshes = set()
+        for ob in objs:
+            if ob.data.name in meshes:
+                continue
+            meshes.add(ob.data.name)
+            if self.add_uv_layer(scene, ob):
+                todo.append(ob)
+
+        if len(todo) < 1:
+            self.report({'INFO'}, "Auto Unwrap found skipping.")
+            return {'FINISHED'}
+
+        if setup.auto_unwrap == 'UNWRAP':
+            # seams unwrap only runs in edit mode, one object at a time
+            for ob in todo:
+                scene.objects.active = ob
+                bpy.ops.object.mode_set(mode='EDIT')
+                bpy.ops.mesh.select_all(action='SELECT')
+                bpy.ops.uv.unwrap()
+                bpy.ops.object.mode_set(mode='OBJECT')
+            self.report({'INFO'}, "Reset UVS using your marked seams.")
+        else:
+            # only objects of the same atlas are unwrapped together, a shared uv space
+            # would shrink the texel density of standalone objects
+            atlases = OrderedDict()
+            standalone = []
+            for ob in todo:
+                group = meltdown_atlas_index.get_group(ob.name)
+                if group is None:
+                    standalone.append(ob)
+                else:
+                    atlases.setdefault(group, []).append(ob)
+
+            selected = [ob for ob in scene.objects if ob.select]
+            if len(standalone) > 0:
+                self.unwrap_objects(scene, setup, standalone)
+            for name, atlas in atlases.items():
+                self.unwrap_atlas(scene, setup, atlas)
+
+            for ob in scene.objects:
+                ob.select = ob in selected
+
+            if setup.auto_unwrap == 'SMART':
+                self.report({'INFO'}, "Reset UVS using Smart UV Project.")
+            if setup.auto_unwrap == 'LIGHTMAP':
+                self.report({'INFO'}, "Reset UVS using Lightmap pack.")
+
+        scene.objects.active = active
+        return {'FINISHED'}
+
     def execute(self, context):
+        if self.batch:
+            return self.execute_batch(context)
+
         wm = context.window_manager
         scene = context.scene
         setup = scene.meltdown_setup
@@ -1223,13 +4012,8 @@ class MeltdownUnwrap(Operator):
         #setup.lightmap_unwrap.PREF_MARGIN_DIV = precision
 
         # use textureAtlas uv if any
-        uvtex_name = 'Auto-Unwrap'
-        if hasattr(scene, "ms_lightmap_groups"):
-            textureAtlasGroupsNames = [group.name for group in scene.ms_lightmap_groups]
-            for group in ob.users_group:
-                if group.name in textureAtlasGroupsNames:
-                    uvtex_name = group.name
-                    break
+        meltdown_atlas_index.build(scene)
+        uvtex_name = meltdown_atlas_index.get_uvtex_name(ob.name)
 
         for uvtex in ob.data.uv_textures:
             if uvtex.name == uvtex_name:
@@ -1300,16 +4084,12 @@ class MeltdownMakeAtlasSetupPassOp(Operator):
             # make texture atlas group and auto-unwrap
             if len(objs) > 1:
                 # find if all objects are allready unwrapped
-                textureAtlasGroupsNames = [group.name for group in scene.ms_lightmap_groups]
+                meltdown_atlas_index.build(scene)
                 do_unwrap = False
                 for obj in objs:
-                    if len(obj.users_group) < 1:
+                    if meltdown_atlas_index.get_group(obj.name) is None:
                         do_unwrap = True
                         break
-                    for group in obj.users_group:
-                        if group.name not in textureAtlasGroupsNames:
-                            do_unwrap = True
-                            break
                 # perform auto texture atlas unwrap
                 if do_unwrap:
                     bpy.ops.scene.ms_add_lightmap_group()
@@ -1324,9 +4104,9 @@ class MeltdownMakeAtlasSetupPassOp(Operator):
                         group.unwrap_type = '1'
                     bpy.ops.object.ms_auto()
 
+        bpy.ops.meltdown.unwrap(batch=True)
+
         for obj in objs:
-            scene.objects.active = obj
-            bpy.ops.meltdown.unwrap()
             pair = job.pairs.add()
             pair.lowpoly = obj.name
 
@@ -1353,9 +4133,9 @@ class MeltdownMakeUniqueSetupPassOp(Operator):
         settings = scene.meltdown_setup
         meltdown_settings = scene.meltdown_settings
         #meltdown_settings.jobs.clear()
+        bpy.ops.meltdown.unwrap(batch=True)
+
         for obj in objs:
-            scene.objects.active = obj
-            bpy.ops.meltdown.unwrap()
 
             # each job share objects and pass settings
             job = meltdown_settings.jobs.add()
@@ -1486,11 +4266,7 @@ class MeltdownMakeBIMaterialOp(Operator):
         jobs  = scene.meltdown_settings.jobs
         # Check for texture atlas group membership
         # and use group name as uvtex_name if any
-
-        if hasattr(scene, "ms_lightmap_groups"):
-            textureAtlasGroupsNames = [group.name for group in scene.ms_lightmap_groups]
-        else:
-            textureAtlasGroupsNames = []
+        meltdown_atlas_index.build(scene)
 
         for job in jobs:
 
@@ -1501,10 +4277,7 @@ class MeltdownMakeBIMaterialOp(Operator):
 
                 # check for texture atlas group membership
                 # and use group name as uv name if any
-                uvtex_name = 'Auto-Unwrap'
-                for group in obj.users_group:
-                    if group.name in textureAtlasGroupsNames:
-                        uvtex_name = group.name
+                uvtex_name = meltdown_atlas_index.get_uvtex_name(obj.name)
 
                 mat = None
                 for name, slot in obj.material_slots.items():
@@ -1962,6 +4735,7 @@ class MeltdownSetupPanel(bpy.types.Panel):
         row = box.row(align=True)
         row.alignment = 'EXPAND'
         row.operator("meltdown.bake", text='Start Baking', icon = "RENDER_STILL")
+        row.operator("meltdown.bake_farm", icon = "NETWORK_DRIVE")
 
 
         row = box.row(align=True)
@@ -2001,10 +4775,62 @@ class MeltdownJobsPanel(bpy.types.Panel):
         wm = context.window_manager
         mds = context.scene.meltdown_settings
 
+        row = layout.row(align=True)
+        row.alignment = 'EXPAND'
+        row.prop(mds, "scene_builder")
+        row = layout.row(align=True)
+        row.alignment = 'EXPAND'
+        row.prop(mds, "target_pool_limit")
+        row = layout.row(align=True)
+        row.alignment = 'EXPAND'
+        row.prop(mds, "postprocess")
+        row.prop(mds, "atlas_batch")
+        sub = row.row(align=True)
+        sub.active = mds.atlas_batch
+        sub.prop(mds, "atlas_batch_lit")
+        row.prop(mds, "dedupe")
+        row = layout.row(align=True)
+        row.alignment = 'EXPAND'
+        row.prop(mds, "derive_passes")
+        row.prop(mds, "rasterize")
+        row = layout.row(align=True)
+        row.alignment = 'EXPAND'
+        row.prop(mds, "pipeline")
+        row.prop(mds, "pipeline_queue")
+        row = layout.row(align=True)
+        row.alignment = 'EXPAND'
+        row.prop(mds, "use_cache")
+        row.prop(mds, "force_rebake")
+        row.prop(mds, "resume")
+        row = layout.row(align=True)
+        row.alignment = 'EXPAND'
+        row.prop(mds, "farm_workers")
+        row.prop(mds, "farm_split")
+        row = layout.row(align=True)
+        row.alignment = 'EXPAND'
+        row.prop(mds, "osd_rate")
+        row.prop(mds, "use_modal")
+        row = layout.row(align=True)
+        row.alignment = 'EXPAND'
+        row.prop(mds, "use_profiler")
+        row.prop(mds, "profile_memory")
+
+        if mds.use_profiler and len(meltdown_profiler.last_summary) > 0:
+            box = layout.box()
+            for name, (count, total, peak) in meltdown_profiler.last_summary.items():
+                row = box.row(align=True)
+                row.label(text=name)
+                row.label(text="%d x" % count)
+                row.label(text="%.2fs" % total)
+                row.label(text="max %.2fs" % peak)
+            row = box.row(align=True)
+            row.alignment = 'EXPAND'
+            row.operator("meltdown.export_profile", icon = "EXPORT")
         row = layout.row(align=True)
         row.alignment = 'EXPAND'
         row.separator()
 
+        meltdown_atlas_index.refresh(context.scene)
         for job_i, job in enumerate(mds.jobs):
 
             if len(job.pairs) > 1:
@@ -2054,6 +4880,12 @@ class MeltdownJobsPanel(bpy.types.Panel):
                     row.alignment = 'EXPAND'
                     row.prop(job, 'aa_sharpness', text="AA sharpness")
 
+                row = box.row(align=True)
+                row.alignment = 'EXPAND'
+                # full copy bakes the whole image at once
+                row.active = mds.scene_builder == 'MINIMAL' and mds.postprocess == 'NUMPY'
+                row.prop(job, 'tiles')
+
                 row = box.row(align=True)
                 row.alignment = 'EXPAND'
                 row.prop(job, 'margin', text="Margin")
@@ -2201,6 +5033,10 @@ def register():
     bpy.types.Scene.meltdown_setup = PointerProperty(type = MeltdownSetup)
     bpy.types.Scene.meltdown_settings = PointerProperty(type = MeltdownSettings)
     bpy.utils.register_module(__name__)
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post, bpy.app.handlers.load_post):
+        handlers.append(invalidate_filenames_handler)
+    for handlers in (bpy.app.handlers.undo_pre, bpy.app.handlers.redo_pre, bpy.app.handlers.load_pre):
+        handlers.append(cancel_bake_handler)
     # use custom props for temporary datas, to clean up the scene when not needed
     #bpy.types.Object.md_orig_name = StringProperty(name="Original Name")
     #bpy.types.Group.md_orig_name = StringProperty(name="Original Name")
@@ -2218,6 +5054,12 @@ def unregister():
     unregister_class(BakeJob)
     unregister_class(MeltdownPref)
     bpy.utils.unregister_module(__name__)
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post, bpy.app.handlers.load_post):
+        if invalidate_filenames_handler in handlers:
+            handlers.remove(invalidate_filenames_handler)
+    for handlers in (bpy.app.handlers.undo_pre, bpy.app.handlers.redo_pre, bpy.app.handlers.load_pre):
+        if cancel_bake_handler in handlers:
+            handlers.remove(cancel_bake_handler)
     del bpy.types.Scene.meltdown_setup
     del bpy.types.Scene.meltdown_settings
     #del bpy.types.Object.md_orig_name
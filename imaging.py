@@ -0,0 +1,215 @@
+#  (c) 2014 by Piotr Adamowicz (MadMinstrel)
+
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# Post process of baked pixels: margin fill, denoise, downsample and image writers.
+# No bpy in here, the module runs in the post process worker processes.
+
+import multiprocessing
+import struct
+import traceback
+import zlib
+import numpy
+
+def dilate_margin(pixels, margin):
+    # copy the nearest baked texel (alpha > 0) into empty texels up to margin pixels away,
+    # a jump flood: a pass per power of two below margin instead of a pass per pixel
+    height, width = pixels.shape[:2]
+    filled = pixels[:, :, 3] > 0.0
+    if margin <= 0 or filled.all() or not filled.any():
+        return pixels
+    rows, cols = numpy.indices((height, width), dtype=numpy.int32)
+    seed_y = numpy.where(filled, rows, -1).astype(numpy.int32)
+    seed_x = numpy.where(filled, cols, -1).astype(numpy.int32)
+    best = numpy.where(filled, 0, numpy.iinfo(numpy.int32).max).astype(numpy.int32)
+    step = 1
+    while step * 2 <= margin:
+        step *= 2
+    steps = []
+    while step >= 1:
+        steps.append(step)
+        step //= 2
+    # one more pass of 1 fixes most of the jump flood misses
+    steps.append(1)
+    for step in steps:
+        for dy in (-step, 0, step):
+            for dx in (-step, 0, step):
+                if (dy == 0 and dx == 0) or abs(dy) >= height or abs(dx) >= width:
+                    continue
+                # texels p and their neighbours q = p + (dy, dx) inside the image
+                p = (slice(max(-dy, 0), height - max(dy, 0)), slice(max(-dx, 0), width - max(dx, 0)))
+                q = (slice(max(dy, 0), height - max(-dy, 0)), slice(max(dx, 0), width - max(-dx, 0)))
+                near_y = seed_y[q]
+                near_x = seed_x[q]
+                dist = (rows[p] - near_y) ** 2 + (cols[p] - near_x) ** 2
+                better = numpy.logical_and(near_y >= 0, dist < best[p])
+                seed_y[p][better] = near_y[better]
+                seed_x[p][better] = near_x[better]
+                best[p][better] = dist[better]
+    # the old one pixel per step growth reached a square of margin pixels
+    grow = numpy.logical_and(numpy.logical_not(filled), seed_y >= 0)
+    grow &= numpy.maximum(numpy.abs(rows - seed_y), numpy.abs(cols - seed_x)) <= margin
+    pixels[grow] = pixels[seed_y[grow], seed_x[grow]]
+    pixels[grow, 3] = 1.0
+    return pixels
+
+def denoise(pixels, islands, normals, strength):
+    # edge avoiding a-trous filter, 3x3 taps spread twice as far each iteration,
+    # a tap only counts on the same uv island and falls off with normal and color differences
+    height, width = pixels.shape[:2]
+    covered = pixels[:, :, 3] > 0.0
+    key = numpy.where(covered, islands, -1).astype(numpy.int32)
+    color = numpy.array(pixels[:, :, :3], dtype=numpy.float32)
+    scale = numpy.float32(-0.5 / (0.02 + 0.3 * strength) ** 2)
+    kernel = (0.25, 0.5, 0.25)
+    for i in range(max(1, int(round(strength * 4)))):
+        step = 1 << i
+        color_sum = color * 0.25
+        weight_sum = numpy.full(key.shape, 0.25, dtype=numpy.float32)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if dy == 0 and dx == 0:
+                    continue
+                sy, sx = dy * step, dx * step
+                if abs(sy) >= height or abs(sx) >= width:
+                    continue
+                # texels p and their taps q = p + (sy, sx) inside the image
+                p = (slice(max(-sy, 0), height - max(sy, 0)), slice(max(-sx, 0), width - max(sx, 0)))
+                q = (slice(max(sy, 0), height - max(-sy, 0)), slice(max(sx, 0), width - max(-sx, 0)))
+                weight = (key[q] == key[p]) * numpy.float32(kernel[dy + 1] * kernel[dx + 1])
+                # normal similarity to the power of 32
+                cosine = normals[p][:, :, 0] * normals[q][:, :, 0] + normals[p][:, :, 1] * normals[q][:, :, 1] + \
+                    normals[p][:, :, 2] * normals[q][:, :, 2]
+                numpy.maximum(cosine, 0.0, out=cosine)
+                for j in range(5):
+                    cosine *= cosine
+                weight *= cosine
+                diff = color[q] - color[p]
+                diff *= diff
+                weight *= numpy.exp((diff[:, :, 0] + diff[:, :, 1] + diff[:, :, 2]) * scale)
+                color_sum[p] += color[q] * weight[:, :, numpy.newaxis]
+                weight_sum[p] += weight
+        color = color_sum / weight_sum[:, :, numpy.newaxis]
+    pixels = numpy.array(pixels, dtype=numpy.float32)
+    pixels[covered, :3] = color[covered]
+    return pixels
+
+def downsample(pixels, factor, filter_width):
+    # box downsample by the anti-aliasing factor, then the sharpness filter:
+    # the average of 4 diagonal shifts by filter_width pixels, as the compositor does
+    height, width = pixels.shape[:2]
+    if factor > 1:
+        pixels = pixels.reshape(height // factor, factor, width // factor, factor, 4).mean(axis=(1, 3))
+    if filter_width > 0.0:
+        for axis in (0, 1):
+            before = numpy.concatenate((pixels.take([0], axis=axis), pixels.take(range(pixels.shape[axis] - 1), axis=axis)), axis=axis)
+            after = numpy.concatenate((pixels.take(range(1, pixels.shape[axis]), axis=axis), pixels.take([-1], axis=axis)), axis=axis)
+            pixels = (1.0 - filter_width) * pixels + 0.5 * filter_width * (before + after)
+    return pixels.astype(numpy.float32)
+
+def linear_to_srgb(pixels):
+    pixels = numpy.array(pixels, dtype=numpy.float32)
+    rgb = numpy.clip(pixels[..., :3], 0.0, 1.0)
+    pixels[..., :3] = numpy.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * rgb ** (1.0 / 2.4) - 0.055)
+    return pixels
+
+def to_bytes(pixels):
+    # 8 bit rgba, the values of byte images are already display encoded
+    return numpy.clip(pixels * 255.0 + 0.5, 0.0, 255.0).astype(numpy.uint8)
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+def write_png(filepath, pixels):
+    height, width = pixels.shape[:2]
+    # filter byte 0 then the row, top row first
+    rows = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = to_bytes(pixels)[::-1].reshape(height, -1)
+    with open(filepath, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        file.write(png_chunk(b'IHDR', struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        file.write(png_chunk(b'IDAT', zlib.compress(rows.tobytes(), 1)))
+        file.write(png_chunk(b'IEND', b''))
+
+def write_tga(filepath, pixels):
+    # uncompressed bgra, bottom row first as blender stores it
+    height, width = pixels.shape[:2]
+    data = to_bytes(pixels)[:, :, [2, 1, 0, 3]]
+    with open(filepath, 'wb') as file:
+        file.write(struct.pack("<BBBHHBHHHHBB", 0, 0, 2, 0, 0, 0, 0, 0, width, height, 32, 8))
+        file.write(data.tobytes())
+
+def write_bmp(filepath, pixels):
+    # 24 bit bgr, bottom row first, rows padded to 4 bytes
+    height, width = pixels.shape[:2]
+    row_size = (width * 3 + 3) & ~3
+    data = numpy.zeros((height, row_size), dtype=numpy.uint8)
+    data[:, :width * 3] = to_bytes(pixels)[:, :, 2::-1].reshape(height, -1)
+    with open(filepath, 'wb') as file:
+        file.write(b'BM' + struct.pack("<IHHI", 54 + data.size, 0, 0, 54))
+        file.write(struct.pack("<IiiHHIIiiII", 40, width, height, 1, 24, 0, data.size, 2835, 2835, 0, 0))
+        file.write(data.tobytes())
+
+def write_tiff(filepath, pixels):
+    # uncompressed rgba in one strip, top row first
+    height, width = pixels.shape[:2]
+    data = to_bytes(pixels)[::-1].tobytes()
+    entries = [(256, 4, width), (257, 4, height), (258, 3, None), (259, 3, 1), (262, 3, 2), (273, 4, 154),
+        (277, 3, 4), (278, 4, height), (279, 4, len(data)), (284, 3, 1), (338, 3, 2)]
+    with open(filepath, 'wb') as file:
+        file.write(b'II' + struct.pack("<HI", 42, 8))
+        file.write(struct.pack("<H", len(entries)))
+        for tag, type, value in entries:
+            if tag == 258:
+                # bits per sample of the 4 channels at offset 146, after the directory
+                file.write(struct.pack("<HHII", tag, type, 4, 146))
+            elif type == 3:
+                file.write(struct.pack("<HHIHH", tag, type, 1, value, 0))
+            else:
+                file.write(struct.pack("<HHII", tag, type, 1, value))
+        file.write(struct.pack("<I", 0))
+        file.write(struct.pack("<HHHH", 8, 8, 8, 8))
+        file.write(data)
+
+# formats the post process worker writes without blender, the others are saved on the main thread
+image_writers = {'PNG': write_png, 'TARGA': write_tga, 'BMP': write_bmp, 'TIFF': write_tiff}
+
+def post_process(task):
+    # margin fill, downsample and file write of one pass, (filepath, pixels or None once written, error)
+    filepath = task['filepath']
+    try:
+        pixels = task['pixels']
+        if task['margin'] > 0:
+            pixels = dilate_margin(pixels, task['margin'])
+        pixels = downsample(pixels, task['factor'], task['filter_width'])
+        if task.get('linear', False):
+            # float targets hold linear light, byte files are display encoded
+            pixels = linear_to_srgb(pixels)
+        if task['format'] in image_writers:
+            image_writers[task['format']](filepath, pixels)
+            pixels = None
+        return filepath, pixels, ""
+    except Exception:
+        return filepath, None, traceback.format_exc()
+
+def post_pool(size):
+    # forked workers inherit this module, spawned ones would import the addon and bpy with it
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context("fork").Pool(max(1, min(size, multiprocessing.cpu_count())))